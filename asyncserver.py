@@ -0,0 +1,307 @@
+#!/usr/bin/env python3.9
+import io
+import os
+import sys
+import signal
+import socket
+import struct
+import asyncio
+import resource
+import traceback
+import concurrent.futures
+import flup.server.fcgi_base as fcgi
+import configuration
+
+assert(isinstance(configuration.server_threads, int) and configuration.server_threads > 0)
+assert(isinstance(configuration.server_thumbnail_threads, int) and configuration.server_thumbnail_threads > 0)
+
+# Largest amount of content a single record can carry
+record_size = 65535
+# Amount of output a response may queue up on the loop before waiting for the web server to take it
+send_buffer_size = 262144
+
+error_page = b'''<!DOCTYPE html>
+<html><head>
+<title>Unhandled Exception</title>
+</head><body>
+<h1>Unhandled Exception</h1>
+<p>An unhandled exception was thrown by the application.</p>
+</body></html>
+'''
+
+def make_record(type, request_id, data=b''):
+	return struct.pack(fcgi.FCGI_Header, fcgi.FCGI_VERSION_1, type, request_id, len(data), 0) + data
+
+def make_end_request(request_id, status):
+	return make_record(fcgi.FCGI_END_REQUEST, request_id, struct.pack(fcgi.FCGI_EndRequestBody, 0, status))
+
+def make_stream(type, request_id, data):
+	return b''.join(make_record(type, request_id, data[i:i + record_size]) for i in range(0, len(data), record_size))
+
+def decode_params(data):
+	params = {}
+	pos = 0
+	while pos < len(data):
+		pos, (name, value) = fcgi.decode_pair(data, pos)
+		params[name.decode('utf-8', errors='surrogateescape')] = value.decode('utf-8', errors='surrogateescape')
+	return params
+
+def make_environ(params, stdin):
+	environ = params
+	environ['wsgi.version'] = (1, 0)
+	environ['wsgi.input'] = stdin
+	environ['wsgi.errors'] = sys.stderr
+	environ['wsgi.multithread'] = True
+	environ['wsgi.multiprocess'] = False
+	environ['wsgi.run_once'] = False
+	environ['wsgi.url_scheme'] = 'https' if environ.get('HTTPS', 'off') in ('on', '1') else 'http'
+
+	# Same defaults as flup, for when the web server leaves some out
+	uri = environ.get('REQUEST_URI', '').split('?', 1)
+	environ.setdefault('SCRIPT_NAME', '')
+	if not environ.get('PATH_INFO'):
+		environ['PATH_INFO'] = uri[0]
+	if not environ.get('QUERY_STRING'):
+		environ['QUERY_STRING'] = uri[1] if len(uri) > 1 else ''
+	environ.setdefault('REQUEST_METHOD', 'GET')
+	environ.setdefault('SERVER_NAME', 'localhost')
+	environ.setdefault('SERVER_PORT', '80')
+	environ.setdefault('SERVER_PROTOCOL', 'HTTP/1.0')
+
+	return environ
+
+def call_application(application, environ, send):
+	# Runs in an executor thread, send blocks until the data has been handed to the web server
+	# Returns whether the response can be ended normally, rather than cut short
+	headers_set = []
+	headers_sent = []
+
+	def write(data):
+		if not headers_sent:
+			status, headers = headers_sent[:] = headers_set
+			lines = ['Status: {0}\r\n'.format(status)]
+			lines.extend('{0}: {1}\r\n'.format(name, value) for name, value in headers)
+			lines.append('\r\n')
+			data = ''.join(lines).encode('utf-8', errors='surrogateescape') + data
+		send(data)
+
+	def start_response(status, headers, exc_info=None):
+		if exc_info and headers_sent:
+			raise exc_info[1].with_traceback(exc_info[2])
+		headers_set[:] = [status, headers]
+		return write
+
+	try:
+		result = application(environ, start_response)
+		try:
+			# Responses produced in one piece get their length, as with flup
+			if headers_set and not headers_sent and isinstance(result, list) and len(result) == 1:
+				if not any(name.lower() == 'content-length' for name, value in headers_set[1]):
+					headers_set[1].append(('Content-Length', str(len(result[0]))))
+
+			for data in result:
+				if data:
+					write(data)
+			if not headers_sent:
+				write(b'')
+		finally:
+			if hasattr(result, 'close'):
+				result.close()
+	except ConnectionError:
+		return False
+	except Exception:
+		traceback.print_exc()
+		if headers_sent:
+			return False
+		if configuration.debug:
+			import cgitb
+			page = cgitb.html(sys.exc_info()).encode('utf-8', errors='replace')
+		else:
+			page = error_page
+		try:
+			send(b'Status: 500 Internal Server Error\r\nContent-Type: text/html\r\n\r\n' + page)
+		except ConnectionError:
+			return False
+	return True
+
+class Connection:
+	__slots__ = ('server', 'reader', 'writer')
+
+	def __init__(self, server, reader, writer):
+		self.server = server
+		self.reader = reader
+		self.writer = writer
+
+	async def read_record(self):
+		version, type, request_id, length, padding = struct.unpack(fcgi.FCGI_Header, await self.reader.readexactly(fcgi.FCGI_HEADER_LEN))
+		content = await self.reader.readexactly(length + padding)
+		return type, request_id, content[:length]
+
+	async def send(self, data):
+		self.writer.write(data)
+		await self.writer.drain()
+
+	async def end_request(self, request_id, status):
+		await self.send(make_end_request(request_id, status))
+
+	async def run(self):
+		# Requests are never multiplexed, so only the current one is tracked
+		current = None
+		keep = True
+		try:
+			while keep:
+				type, request_id, content = await self.read_record()
+
+				if request_id == fcgi.FCGI_NULL_REQUEST_ID:
+					if type == fcgi.FCGI_GET_VALUES:
+						await self.send(make_record(fcgi.FCGI_GET_VALUES_RESULT, 0, self.server.get_values(content)))
+					else:
+						await self.send(make_record(fcgi.FCGI_UNKNOWN_TYPE, 0, struct.pack(fcgi.FCGI_UnknownTypeBody, type)))
+
+				elif type == fcgi.FCGI_BEGIN_REQUEST:
+					role, flags = struct.unpack(fcgi.FCGI_BeginRequestBody, content)
+					if current:
+						await self.end_request(request_id, fcgi.FCGI_CANT_MPX_CONN)
+					elif role != fcgi.FCGI_RESPONDER:
+						await self.end_request(request_id, fcgi.FCGI_UNKNOWN_ROLE)
+						keep = flags & fcgi.FCGI_KEEP_CONN
+					else:
+						current = (request_id, flags, [], [])
+
+				elif not current or request_id != current[0]:
+					continue
+
+				elif type == fcgi.FCGI_ABORT_REQUEST:
+					await self.end_request(request_id, fcgi.FCGI_REQUEST_COMPLETE)
+					keep = current[1] & fcgi.FCGI_KEEP_CONN
+					current = None
+
+				elif type == fcgi.FCGI_PARAMS:
+					current[2].append(content)
+
+				# The request only starts once its whole body has been received, as it is read in one go anyway
+				elif type == fcgi.FCGI_STDIN:
+					if content:
+						current[3].append(content)
+						continue
+
+					request_id, flags, params, stdin = current
+					current = None
+					await self.server.respond(self, request_id, decode_params(b''.join(params)), b''.join(stdin))
+					keep = flags & fcgi.FCGI_KEEP_CONN
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			self.writer.close()
+
+class Server:
+	__slots__ = ('application', 'loop', 'executors', 'default_executor', 'capability', 'active', 'connections')
+
+	def __init__(self, application):
+		self.application = application
+		self.loop = None
+		# Thumbnails may each keep a thread busy for seconds, so they get their own threads, and cannot starve everything else
+		self.executors = {
+			'thumbnail': concurrent.futures.ThreadPoolExecutor(configuration.server_thumbnail_threads, 'thumbnail')
+		}
+		self.default_executor = concurrent.futures.ThreadPoolExecutor(configuration.server_threads, 'server')
+		connections = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+		self.capability = {
+			fcgi.FCGI_MAX_CONNS: connections,
+			fcgi.FCGI_MAX_REQS: connections,
+			fcgi.FCGI_MPXS_CONNS: 0
+		}
+		self.active = set()
+		# Connection to the task running it
+		self.connections = {}
+
+	def get_values(self, content):
+		pos = 0
+		values = b''
+		while pos < len(content):
+			pos, (name, value) = fcgi.decode_pair(content, pos)
+			capability = self.capability.get(name.decode('ascii', errors='replace'))
+			if capability is not None:
+				values += fcgi.encode_pair(name, str(capability).encode('ascii'))
+		return values
+
+	async def respond(self, connection, request_id, params, stdin):
+		environ = make_environ(params, io.BytesIO(stdin))
+		executor = self.executors.get(environ.get('archive.module'), self.default_executor)
+
+		queued = 0
+
+		def send(data):
+			# Waiting for every write to go through the loop would cost a round trip each time
+			nonlocal queued
+			records = make_stream(fcgi.FCGI_STDOUT, request_id, data)
+			self.loop.call_soon_threadsafe(connection.writer.write, records)
+			queued += len(records)
+			if queued >= send_buffer_size:
+				asyncio.run_coroutine_threadsafe(connection.writer.drain(), self.loop).result()
+				queued = 0
+
+		def finish(future, completed):
+			# Ends the response along with the last of its output, in the same trip through the loop
+			if completed:
+				connection.writer.write(make_record(fcgi.FCGI_STDOUT, request_id) + make_end_request(request_id, fcgi.FCGI_REQUEST_COMPLETE))
+			else:
+				# A response that failed after its headers went out must not look complete to the web server
+				connection.writer.close()
+			if not future.done():
+				future.set_result(None)
+
+		def run(future):
+			completed = False
+			try:
+				completed = call_application(self.application, environ, send)
+			finally:
+				self.loop.call_soon_threadsafe(finish, future, completed)
+
+		future = self.loop.create_future()
+		executor.submit(run, future)
+		self.active.add(future)
+		try:
+			await future
+		finally:
+			self.active.discard(future)
+
+		await connection.writer.drain()
+
+	async def handle(self, reader, writer):
+		connection = Connection(self, reader, writer)
+		self.connections[connection] = asyncio.current_task()
+		try:
+			await connection.run()
+		finally:
+			del self.connections[connection]
+
+	async def serve(self, path, umask):
+		self.loop = asyncio.get_running_loop()
+
+		stopped = asyncio.Event()
+		for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+			self.loop.add_signal_handler(signum, stopped.set)
+
+		old_umask = os.umask(umask)
+		try:
+			server = await asyncio.start_unix_server(self.handle, path, backlog=socket.SOMAXCONN)
+		finally:
+			os.umask(old_umask)
+
+		await stopped.wait()
+		server.close()
+
+		# Responses being sent still need the loop to get out, connections are closed once they are done
+		if self.active:
+			await asyncio.wait(self.active)
+		for connection in self.connections:
+			connection.writer.close()
+		if self.connections:
+			await asyncio.wait(self.connections.values())
+
+		for executor in [self.default_executor] + list(self.executors.values()):
+			executor.shutdown()
+
+	def run(self, path, umask):
+		asyncio.run(self.serve(path, umask))
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3.9
+import io
+import os
+import sys
+import zlib
+import time
+import shutil
+import signal
+import socket
+import struct
+import sqlite3
+import threading
+import collections
+import tracemalloc
+import tempfile
+import flup.server.fcgi
+import flup.server.fcgi_fork
+import flup.server.fcgi_base as fcgi
+import configuration
+
+# Everything runs against a throwaway database and export, which must be configured before the other modules are loaded
+temporary_directory = tempfile.mkdtemp(prefix='archive-benchmark-')
+files_directory = os.path.join(temporary_directory, 'files')
+configuration.database_directory = temporary_directory
+configuration.exported_directories = {'benchmark': files_directory}
+
+import common
+import database
+import randomid
+import linkstore
+import gallery
+import download
+import server
+import asyncserver
+
+extensions = ['.jpg', '.png', '.mp3', '.flac', '.mkv', '.mp4', '.txt', '.pdf']
+
+def create_files(count):
+	os.makedirs(files_directory, exist_ok=True)
+	for i in range(count):
+		with open(os.path.join(files_directory, 'file{0:07}{1}'.format(i, extensions[i % len(extensions)])), 'wb'):
+			pass
+
+	# Backdate the directory so the listing cache does not consider it as being modified
+	past = time.time() - 60.0
+	os.utime(files_directory, (past, past))
+
+def report(label, elapsed, count, unit='file'):
+	print('{0}: {1:.3f} s, {2:.2f} us/{3}, {4:.0f} {3}s/s'.format(label, elapsed, elapsed / count * 1000000.0, unit, count / elapsed))
+
+def benchmark_listing(count=100000, rounds=3):
+	create_files(count)
+	mount_path = ('benchmark', '')
+	sort_info = ('name', False, False)
+
+	start = time.perf_counter()
+	gallery.scan_directory(mount_path, files_directory, sort_info, 'benchmark', False)
+	report('cold listing', time.perf_counter() - start, count)
+
+	for i in range(rounds):
+		start = time.perf_counter()
+		gallery.scan_directory(mount_path, files_directory, sort_info, 'benchmark-mint{0}'.format(i), False)
+		report('listing, minting', time.perf_counter() - start, count)
+
+	for i in range(rounds):
+		start = time.perf_counter()
+		gallery.scan_directory(mount_path, files_directory, sort_info, 'benchmark', False)
+		report('listing, reusing', time.perf_counter() - start, count)
+
+def benchmark_entries(count=100000):
+	create_files(count)
+	mount_path = ('benchmark', '')
+	sort_info = ('name', False, False)
+	gallery.scan_directory(mount_path, files_directory, sort_info, 'benchmark', False)
+
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	directory = gallery.scan_directory(mount_path, files_directory, sort_info, 'benchmark', False)
+	after, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	print('retained: {0:.1f} MiB, {1:.0f} bytes/file'.format((after - before) / 1048576.0, (after - before) / count))
+	print('peak: {0:.1f} MiB, {1:.0f} bytes/file'.format((peak - before) / 1048576.0, (peak - before) / count))
+	del directory
+
+def benchmark_ids(count=100000, rounds=3):
+	states = range(count)
+
+	for i in range(rounds):
+		start = time.perf_counter()
+		for state in states:
+			randomid.make_id(state)
+		report('make_id', time.perf_counter() - start, count, 'ID')
+
+	for i in range(rounds):
+		start = time.perf_counter()
+		randomid.make_ids(states)
+		report('make_ids', time.perf_counter() - start, count, 'ID')
+
+def benchmark_download(count=1000, requests=20000, rounds=3):
+	create_files(count)
+	directory, total = gallery.scan_directory(('benchmark', ''), files_directory, ('name', False, False), 'benchmark', False)
+	ids = [entry.id for entry in directory]
+
+	for i in range(rounds):
+		start = time.perf_counter()
+		for j in range(requests):
+			status, headers = download.handler({}, None, ids[j % len(ids)])
+			assert(status == 200)
+		report('download.handler', time.perf_counter() - start, requests, 'request')
+
+def benchmark_compression(count=10000, rounds=10):
+	create_files(count)
+
+	listings = []
+	for query, cookie in [('', 'listmode=1'), ('', ''), ('json', '')]:
+		writer = io.StringIO()
+		gallery.handler({'QUERY_STRING': query, 'HTTP_COOKIE': cookie, 'REMOTE_USER': 'benchmark', 'wsgi.url_scheme': 'http', 'HTTP_HOST': 'localhost'}, writer, 'benchmark/')
+		listings.append((query or 'html', cookie, writer.getvalue().encode('utf-8')))
+
+	for query, cookie, data in listings:
+		print('{0}{1}: {2:.1f} KiB'.format(query, ', ' + cookie if cookie else '', len(data) / 1024.0))
+		for level in range(1, 10):
+			start = time.process_time()
+			for i in range(rounds):
+				compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+				size = len(compressor.compress(data)) + len(compressor.flush())
+			elapsed = time.process_time() - start
+			print('  level {0}: {1:.2f} ms CPU/listing, {2:.1f} KiB ({3:.1f} %)'.format(level, elapsed / rounds * 1000.0, size / 1024.0, size / len(data) * 100.0))
+
+def benchmark_stores(count=1000, users=4, browsers=2, listings=20, downloaders=6, requests=5000):
+	# Links for the same files are handed out to a few users while others download, as on a busy server
+	items = [('benchmark', 'file{0:07}{1}'.format(i, extensions[i % len(extensions)])) for i in range(count)]
+	stores = [
+		('sqlite', linkstore.SQLiteStore()),
+		('memory', linkstore.MemoryStore()),
+		('dbm', linkstore.DbmStore(os.path.join(temporary_directory, 'links')))
+	]
+
+	for name, store in stores:
+		now = int(time.time())
+		links = store.mint('benchmark', items, now + 3600, now + 1800)
+		finished = {}
+
+		def browse(i):
+			for j in range(listings):
+				store.mint('benchmark{0}'.format((i + j) % users), items, now + 3600, now + 1800)
+			finished[('browse', i)] = time.perf_counter()
+
+		def download(i):
+			counts = collections.Counter()
+			for j in range(requests):
+				state, noise = links[(i * 7919 + j) % len(links)]
+				assert(store.resolve(state, noise, now))
+				counts[state] += 1
+			store.add_hits(counts)
+			finished[('download', i)] = time.perf_counter()
+
+		workers = [threading.Thread(target=browse, args=(i,)) for i in range(browsers)]
+		workers.extend(threading.Thread(target=download, args=(i,)) for i in range(downloaders))
+
+		start = time.perf_counter()
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+
+		report('{0}, browsing'.format(name), max(v for k, v in finished.items() if k[0] == 'browse') - start, browsers * listings * count, 'link')
+		report('{0}, downloading'.format(name), max(v for k, v in finished.items() if k[0] == 'download') - start, downloaders * requests, 'request')
+
+def start_server(mode, path):
+	pid = os.fork()
+	if pid == 0:
+		try:
+			if mode == 'asyncio':
+				asyncserver.Server(server.dispatcher).run(path, 0o077)
+			elif mode == 'prefork':
+				flup.server.fcgi_fork.WSGIServer(server.dispatcher, bindAddress=path, umask=0o077, debug=False, minSpare=configuration.server_min_spare, maxSpare=configuration.server_max_spare, maxChildren=configuration.server_max_children, maxRequests=configuration.server_max_requests).run()
+			else:
+				flup.server.fcgi.WSGIServer(server.dispatcher, bindAddress=path, umask=0o077, debug=False, maxThreads=configuration.server_max_threads, maxQueued=configuration.server_max_queued).run()
+		finally:
+			os._exit(0)
+
+	# The socket is bound before it is listened on
+	while True:
+		try:
+			close_server(connect_server(path))
+			return pid
+		except (FileNotFoundError, ConnectionRefusedError):
+			time.sleep(0.01)
+
+def server_status(pid):
+	status = {}
+	with open('/proc/{0}/status'.format(pid)) as fp:
+		for line in fp:
+			key, _, value = line.partition(':')
+			status[key] = value.strip()
+	return status
+
+def connect_server(path):
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.connect(path)
+	return sock, sock.makefile('rb')
+
+def close_server(connection):
+	# The socket is only closed along with its file
+	sock, stream = connection
+	stream.close()
+	sock.close()
+
+def request_server(connection, params, keep=True):
+	# Same records as sent by Nginx, with fastcgi_keep_conn on if keep
+	sock, stream = connection
+	body = b''.join(fcgi.encode_pair(name.encode('utf-8'), value.encode('utf-8')) for name, value in params.items())
+	sock.sendall(b''.join([
+		asyncserver.make_record(fcgi.FCGI_BEGIN_REQUEST, 1, struct.pack(fcgi.FCGI_BeginRequestBody, fcgi.FCGI_RESPONDER, fcgi.FCGI_KEEP_CONN if keep else 0)),
+		asyncserver.make_record(fcgi.FCGI_PARAMS, 1, body),
+		asyncserver.make_record(fcgi.FCGI_PARAMS, 1),
+		asyncserver.make_record(fcgi.FCGI_STDIN, 1)
+	]))
+
+	output = []
+	while True:
+		header = stream.read(fcgi.FCGI_HEADER_LEN)
+		if len(header) < fcgi.FCGI_HEADER_LEN:
+			return None
+		version, type, request_id, length, padding = struct.unpack(fcgi.FCGI_Header, header)
+		content = stream.read(length + padding)[:length]
+		if type == fcgi.FCGI_STDOUT:
+			output.append(content)
+		elif type == fcgi.FCGI_END_REQUEST:
+			return b''.join(output)
+
+def run_clients(path, clients, requests, make_params):
+	def client(i):
+		connection = connect_server(path)
+		for j in range(requests):
+			assert(request_server(connection, make_params(i * requests + j)).startswith(b'Status: 200'))
+		close_server(connection)
+
+	workers = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+	start = time.perf_counter()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	return time.perf_counter() - start
+
+def run_burst(path, clients, requests, make_params):
+	# A connection per request, as Nginx does by default, from more clients at once than there are threads
+	failed = []
+
+	def client(i):
+		for j in range(requests):
+			try:
+				connection = connect_server(path)
+				try:
+					response = request_server(connection, make_params(i * requests + j), False)
+				finally:
+					close_server(connection)
+			except ConnectionError:
+				response = None
+			if not response or not response.startswith(b'Status: 200'):
+				failed.append(i)
+
+	workers = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+	start = time.perf_counter()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	return time.perf_counter() - start, len(failed)
+
+def benchmark_servers(count=1000, clients=8, requests=2000, listings=20, burst=256, idle=2000):
+	create_files(count)
+	directory, total = gallery.scan_directory(('benchmark', ''), files_directory, ('name', False, False), 'benchmark', False)
+	uris = [configuration.download_prefix + entry.id for entry in directory]
+
+	def make_params(uri, module):
+		return {'REQUEST_METHOD': 'GET', 'DOCUMENT_URI': uri, 'REQUEST_URI': uri, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'localhost', 'REMOTE_USER': configuration.browse_users[0], 'archive.module': module}
+
+	def make_download_params(i):
+		return make_params(uris[i * 7919 % len(uris)], 'download')
+
+	def make_listing_params(i):
+		return make_params(configuration.browse_prefix + 'benchmark/', 'gallery')
+
+	for mode in ('threaded', 'asyncio', 'prefork'):
+		path = os.path.join(temporary_directory, '{0}.socket'.format(mode))
+		pid = start_server(mode, path)
+		try:
+			report('{0}, {1} busy connections'.format(mode, clients), run_clients(path, clients, requests, make_download_params), clients * requests, 'request')
+			# Rendering is where a single process is bound by the GIL
+			report('{0}, {1} connections listing {2} files'.format(mode, clients, count), run_clients(path, clients, listings, make_listing_params), clients * listings, 'listing')
+
+			elapsed, failed = run_burst(path, burst, requests // 100, make_download_params)
+			report('{0}, {1} clients connecting for each request, {2} failed'.format(mode, burst, failed), elapsed, burst * (requests // 100), 'request')
+
+			# Each connection holds a thread, or a child, for as long as it is open, so idle ones would hold them all
+			if mode != 'asyncio':
+				continue
+
+			# Connections Nginx keeps open between requests, which sit idle most of the time, while one stays busy
+			connection = connect_server(path)
+			connections = []
+			dropped = 0
+			for i in range(idle):
+				connections.append(connect_server(path))
+				try:
+					if request_server(connections[-1], make_download_params(i)) is None:
+						dropped += 1
+				except ConnectionError:
+					dropped += 1
+
+			status = server_status(pid)
+			print('{0}, {1} idle connections: {2} dropped, {3} threads, {4} resident'.format(mode, idle, dropped, status['Threads'], status['VmRSS']))
+
+			start = time.perf_counter()
+			for j in range(requests):
+				request_server(connection, make_download_params(j))
+			report('{0}, 1 busy connection, {1} idle'.format(mode, idle), time.perf_counter() - start, requests, 'request')
+
+			for connection in connections + [connection]:
+				close_server(connection)
+		finally:
+			os.kill(pid, signal.SIGTERM)
+			os.waitpid(pid, 0)
+
+def report_size(label, db, count):
+	size = db.execute('PRAGMA page_count').fetchone()[0] * db.execute('PRAGMA page_size').fetchone()[0]
+	print('{0}: {1:.1f} MiB, {2:.1f} bytes/row'.format(label, size / 1048576.0, size / count))
+
+	try:
+		for name, table_size in db.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY SUM(pgsize) DESC LIMIT 5'):
+			print('  {0}: {1:.1f} MiB'.format(name, table_size / 1048576.0))
+	except sqlite3.OperationalError:
+		pass
+
+def benchmark_schema(count=10000000, paths=1000000, chunk=100000):
+	# Links are handed out repeatedly for the same files, to a few users, so there are far fewer distinct paths than rows
+	db = sqlite3.connect(os.path.join(temporary_directory, 'schema.sqlite'))
+	db.execute('PRAGMA journal_mode = OFF')
+	db.execute('PRAGMA synchronous = OFF')
+
+	with db:
+		database.apply_migration(db, database.migrations[0])
+
+	now = int(time.time())
+	for offset in range(0, count, chunk):
+		states = range(offset, min(count, offset + chunk))
+		rows = []
+		for state, id in zip(states, randomid.make_ids(states)):
+			path = state * 7919 % paths
+			rows.append((id, now + state % 86400, 'user{0}'.format(state % 50), 0, 0, 'mount{0}'.format(path % 4), 'directory{0:05}/file{1:07}.jpg'.format(path // 100, path)))
+		with db:
+			db.executemany('INSERT INTO ids (id, expires, user, download, hits, mount, path) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+	db.execute('VACUUM')
+	report_size('before', db, count)
+
+	for version, migration in enumerate(database.migrations[1:], 2):
+		start = time.perf_counter()
+		with db:
+			database.apply_migration(db, migration)
+		print('migration to version {0}: {1:.1f} s'.format(version, time.perf_counter() - start))
+
+		db.execute('VACUUM')
+		report_size('version {0}'.format(version), db, count)
+
+	db.close()
+
+benchmarks = {
+	'listing': benchmark_listing,
+	'entries': benchmark_entries,
+	'ids': benchmark_ids,
+	'download': benchmark_download,
+	'compression': benchmark_compression,
+	'stores': benchmark_stores,
+	'servers': benchmark_servers,
+	'schema': benchmark_schema
+}
+
+if __name__ == '__main__':
+	argv = sys.argv[1:] or list(benchmarks.keys())
+	try:
+		for name in argv:
+			print('== {0} =='.format(name))
+			benchmarks[name]()
+	finally:
+		shutil.rmtree(temporary_directory)
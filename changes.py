@@ -0,0 +1,223 @@
+#!/usr/bin/env python3.9
+import os
+import struct
+import ctypes
+import threading
+import collections
+import common
+import configuration
+import dircache
+
+assert(isinstance(configuration.changes_watch_limit, int))
+assert(isinstance(configuration.changes_log_length, int))
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+creation_mask = IN_CREATE | IN_MOVED_TO
+
+event_header = struct.Struct('iIII')
+
+try:
+	libc = ctypes.CDLL(None, use_errno=True)
+
+	inotify_init1 = libc.inotify_init1
+	inotify_init1.argtypes = [ctypes.c_int]
+	inotify_init1.restype = ctypes.c_int
+
+	inotify_add_watch = libc.inotify_add_watch
+	inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+	inotify_add_watch.restype = ctypes.c_int
+
+	inotify_rm_watch = libc.inotify_rm_watch
+	inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+	inotify_rm_watch.restype = ctypes.c_int
+except (OSError, AttributeError):
+	libc = None
+
+class Watch:
+	__slots__ = ('descriptor', 'fs_path', 'floor', 'events')
+
+	def __init__(self, descriptor, fs_path, floor):
+		self.descriptor = descriptor
+		self.fs_path = fs_path
+		# Sequence number after which every event is still in the log
+		self.floor = floor
+		self.events = collections.deque()
+
+# Tokens handed out by another process, or before a restart, must never be mistaken for ours
+instance = os.urandom(4).hex()
+
+lock = threading.Lock()
+inotify_fd = None
+sequence = 0
+watches = collections.OrderedDict()
+descriptors = {}
+
+def reset_after_fork():
+	# The thread reading events is left behind, and tokens handed out before must not be taken for ours
+	global lock, inotify_fd, instance
+
+	lock = threading.Lock()
+	if inotify_fd is not None:
+		os.close(inotify_fd)
+		inotify_fd = None
+	instance = os.urandom(4).hex()
+	watches.clear()
+	descriptors.clear()
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def make_token(value):
+	return '{0}-{1:x}'.format(instance, value)
+
+def parse_token(token):
+	split = token.split('-', 1)
+	if len(split) != 2 or split[0] != instance:
+		return None
+
+	try:
+		return int(split[1], 16)
+	except ValueError:
+		return None
+
+def start_unlocked():
+	global inotify_fd
+
+	if inotify_fd is not None:
+		return True
+	if not libc:
+		return False
+
+	result = inotify_init1(IN_CLOEXEC)
+	if result < 0:
+		return False
+
+	inotify_fd = result
+	threading.Thread(target=run, name='inotify', daemon=True).start()
+	return True
+
+def drop_unlocked(watch):
+	if watches.get(watch.fs_path) is watch:
+		del watches[watch.fs_path]
+	if descriptors.get(watch.descriptor) is watch:
+		del descriptors[watch.descriptor]
+
+def watch(fs_path):
+	global sequence
+
+	fs_path = os.path.normpath(fs_path)
+
+	with lock:
+		current = watches.get(fs_path)
+		if current:
+			watches.move_to_end(fs_path)
+			return make_token(sequence)
+
+		if not start_unlocked():
+			return None
+
+		descriptor = inotify_add_watch(inotify_fd, os.fsencode(fs_path), watch_mask)
+		if descriptor < 0 or descriptor in descriptors:
+			# Failed, or the same directory is already being watched through another path
+			return None
+
+		# Changes made while unwatched were never logged, so tokens from before must reset
+		sequence += 1
+		current = Watch(descriptor, fs_path, sequence)
+		watches[fs_path] = current
+		descriptors[descriptor] = current
+
+		while len(watches) > configuration.changes_watch_limit:
+			_, old = watches.popitem(last=False)
+			del descriptors[old.descriptor]
+			inotify_rm_watch(inotify_fd, old.descriptor)
+
+		return make_token(sequence)
+
+def get_changes(fs_path, token):
+	fs_path = os.path.normpath(fs_path)
+	value = parse_token(token)
+
+	with lock:
+		current = watches.get(fs_path)
+		if value is None or not current or value < current.floor or value > sequence:
+			return None
+
+		watches.move_to_end(fs_path)
+
+		changed = {}
+		for event_sequence, name, mask in reversed(current.events):
+			if event_sequence <= value:
+				break
+			if name:
+				changed[name] = mask
+
+		return (make_token(sequence), changed)
+
+def process_event(descriptor, mask, name):
+	global sequence
+
+	if mask & IN_Q_OVERFLOW:
+		# Events were lost, so every log is now incomplete
+		sequence += 1
+		for current in watches.values():
+			current.floor = sequence
+			current.events.clear()
+		return list(watches.keys())
+
+	current = descriptors.get(descriptor)
+	if not current:
+		return []
+
+	if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+		drop_unlocked(current)
+		if not mask & IN_IGNORED:
+			inotify_rm_watch(inotify_fd, descriptor)
+		return [current.fs_path]
+
+	# Changes to the directory itself have no name, and change none of its entries
+	if not name:
+		return [current.fs_path]
+
+	sequence += 1
+	current.events.append((sequence, name, mask))
+	while len(current.events) > configuration.changes_log_length:
+		current.floor = current.events.popleft()[0]
+
+	return [current.fs_path]
+
+def run():
+	while True:
+		try:
+			buffer = os.read(inotify_fd, 65536)
+		except InterruptedError:
+			continue
+
+		offset = 0
+		invalidated = set()
+		with lock:
+			while offset < len(buffer):
+				descriptor, mask, cookie, length = event_header.unpack_from(buffer, offset)
+				offset += event_header.size
+				name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+				offset += length
+
+				invalidated.update(process_event(descriptor, mask, name))
+
+			# Also catches changes to file contents, which leave the directory modification time untouched
+			# Done before the lock is released, so that no listing from before is ever handed out along with the new sequence
+			for fs_path in invalidated:
+				dircache.invalidate(fs_path)
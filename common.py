@@ -21,11 +21,17 @@ for key, path in configuration.exported_directories.items():
 
 configuration.hidden_directory_names = set(configuration.hidden_directory_names)
 configuration.hidden_file_names = set(configuration.hidden_file_names)
+configuration.scan_lazy_stat = set(configuration.scan_lazy_stat)
 
 configuration.image_extensions = set(configuration.image_extensions)
 configuration.audio_extensions = set(configuration.audio_extensions)
 configuration.video_extensions = set(configuration.video_extensions)
 
+media_kinds = {}
+media_kinds.update((extension, 'video') for extension in configuration.video_extensions)
+media_kinds.update((extension, 'audio') for extension in configuration.audio_extensions)
+media_kinds.update((extension, 'image') for extension in configuration.image_extensions)
+
 assert(sys.getfilesystemencoding() == 'utf-8')
 
 socket_path = os.path.join(configuration.socket_directory, 'archive.socket')
@@ -11,7 +11,23 @@ browse_users = ['guest']
 editor_users = ['editor']
 
 download_delay = 3600
+download_reuse_minimum = 1800
+download_hits_flush_interval = 10
+id_cache_entries = 100000
 time_format = '%x %X'
+gzip_level = 4
+gzip_minimum_size = 1024
+
+# Server
+server_mode = 'threaded'
+server_threads = 16
+server_thumbnail_threads = 4
+server_max_threads = 64
+server_max_queued = 256
+server_min_spare = 1
+server_max_spare = 5
+server_max_children = 50
+server_max_requests = 0
 
 # Webserver
 static_prefix = '/static/'
@@ -32,6 +48,14 @@ exported_directories = {
 	'example': '/mnt/other'
 }
 
+# Database
+database_cache_size = -16384
+database_mmap_size = 268435456
+database_synchronous = 'NORMAL'
+database_busy_timeout = 5000
+database_cleanup_batch = 10000
+link_store = 'sqlite'
+
 hidden_directory_names = ['$RECYCLE.BIN']
 hidden_file_names = ['desktop.ini', 'Thumbs.db']
 
@@ -43,12 +67,31 @@ rid_symbols = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
 
 rid_bits_state = 32
 rid_bits_noise = 31
+rid_state_block = 65536
+
+rid_mode = 'random'
+rid_signing_key = None
+rid_revoked_refresh = 60
 
 # Browsing
 image_extensions = ['.bmp', '.gif', '.jpe', '.jpg', '.jpeg', '.png']
 audio_extensions = ['.aiff', '.flac', '.m4a', '.mp3', '.ogg', '.wav', '.wma']
 video_extensions = ['.3gp', '.asf', '.avi', '.f4v', '.flv', '.m4v', '.mkv', '.mov', '.mpg', '.mpeg', '.mp4', '.mts', '.ts', '.webm', '.wmv']
 
+listing_cache_entries = 50000
+browse_page_size = None
+
+scan_stat_threads = {}
+scan_lazy_stat = []
+
+changes_watch_limit = 1024
+changes_log_length = 10000
+
+volume_refresh_interval = 60
+volume_refresh_timeout = 5
+
+search_limit = 1000
+
 thumbnail_nice = 20
 thumbnail_concurrent = 4
 thumbnail_filename_salt = b'changeme'
@@ -6,16 +6,43 @@ import subprocess
 import common
 import configuration
 import database
+import linkstore
+import search
+import dirsizes
 
 find_binary = '/usr/bin/find'
 rm_binary = '/bin/rm'
 
 assert(isinstance(configuration.thumbnail_expire_days, int))
+assert(isinstance(configuration.database_cleanup_batch, int) and configuration.database_cleanup_batch > 0)
+
+def clean_expired_ids(verbose=False):
+	now = int(time.time())
+	deleted = 0
+
+	# Links kept in memory only exist in the server process, which purges them itself
+	if configuration.link_store == 'memory':
+		if verbose:
+			print('expired links are purged by the server')
+	else:
+		# Many short transactions, so that browsing can take the write lock in between
+		while True:
+			count = linkstore.store.purge_expired(now, configuration.database_cleanup_batch)
+			deleted += count
+
+			if verbose:
+				print('{0} expired links deleted'.format(deleted))
+			if count < configuration.database_cleanup_batch:
+				break
 
-def clean_expired_ids():
 	with contextlib.closing(database.open_database()) as db:
 		with db:
-			db.execute("DELETE FROM ids WHERE expires <= ?", (int(time.time()),))
+			db.execute("DELETE FROM revoked_ids WHERE expires <= ?", (now,))
+
+		# Deleted pages only become reusable, and the WAL file only shrinks, once checkpointed
+		busy, log_pages, checkpointed = db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+		if verbose:
+			print('checkpoint: {0} of {1} pages{2}'.format(checkpointed, log_pages, ', busy' if busy else ''))
 
 def clean_old_thumbnails():
 	argv = [find_binary, configuration.thumbnail_cache_directory, '-type', 'f', '-mtime', '+{0}'.format(configuration.thumbnail_expire_days), '-exec', rm_binary, '--', '{}', '+']
@@ -24,6 +51,9 @@ def clean_old_thumbnails():
 if __name__ == '__main__':
 	argv = sys.argv[1:]
 	if 'hourly' in argv:
-		clean_expired_ids()
+		clean_expired_ids('verbose' in argv)
 	if 'daily' in argv:
 		clean_old_thumbnails()
+	if 'index' in argv:
+		search.crawl()
+		dirsizes.crawl()
@@ -1,23 +1,145 @@
 #!/usr/bin/env python3.9
 import os
 import sqlite3
+import threading
 import common
 import configuration
 
+assert(isinstance(configuration.database_cache_size, int))
+assert(isinstance(configuration.database_mmap_size, int))
+assert(configuration.database_synchronous in ('OFF', 'NORMAL', 'FULL', 'EXTRA'))
+assert(isinstance(configuration.database_busy_timeout, int))
+
 database_path = os.path.join(configuration.database_directory, 'archive.sqlite')
 
-def open_database():
+def migrate_ids_to_states(db):
+	# Loaded here, as randomid itself depends on this module
+	import randomid
+
+	db.execute("CREATE TABLE ids_states (state INTEGER PRIMARY KEY, noise INTEGER NOT NULL, expires INTEGER NOT NULL, user INTEGER NULL, download INTEGER NOT NULL, hits INTEGER NOT NULL, path INTEGER NOT NULL)")
+
+	# IDs that don't decode with the current random ID configuration could never have been looked up again anyway
+	rows = []
+	for id, expires, user, download, hits, path in db.execute("SELECT id, expires, user, download, hits, path FROM ids"):
+		parsed = randomid.parse_id(id)
+		if parsed:
+			rows.append(parsed + (expires, user, download, hits, path))
+		if len(rows) >= 100000:
+			db.executemany("INSERT OR IGNORE INTO ids_states (state, noise, expires, user, download, hits, path) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+			rows = []
+	db.executemany("INSERT OR IGNORE INTO ids_states (state, noise, expires, user, download, hits, path) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+	db.execute("DROP TABLE ids")
+	db.execute("ALTER TABLE ids_states RENAME TO ids")
+	db.execute("CREATE INDEX ids_path_user_download_index ON ids (path ASC, user ASC, download ASC)")
+
+# Each entry upgrades the schema by one version, as tracked by PRAGMA user_version; existing entries must never be changed
+migrations = [
+	[
+		"CREATE TABLE IF NOT EXISTS ids (id TEXT NOT NULL, expires INTEGER NOT NULL, user TEXT NULL, download INTEGER NOT NULL, hits INTEGER NOT NULL, mount TEXT NOT NULL, path TEXT NOT NULL)",
+		"CREATE UNIQUE INDEX IF NOT EXISTS ids_id_index ON ids (id ASC)",
+		"CREATE INDEX IF NOT EXISTS ids_mount_path_user_download_index ON ids (mount ASC, path ASC, user ASC, download ASC)",
+		"CREATE TABLE IF NOT EXISTS state (key TEXT NOT NULL, value)",
+		"CREATE UNIQUE INDEX IF NOT EXISTS state_key_index ON state (key ASC)",
+		"CREATE TABLE IF NOT EXISTS search_files (mount TEXT NOT NULL, directory TEXT NOT NULL, name TEXT NOT NULL, is_directory INTEGER NOT NULL, mtime INTEGER NULL, used INTEGER NULL, size INTEGER NULL)",
+		"CREATE INDEX IF NOT EXISTS search_files_directory_index ON search_files (mount ASC, directory ASC)",
+		"CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(name, content='search_files', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')",
+		"CREATE TRIGGER IF NOT EXISTS search_files_insert AFTER INSERT ON search_files BEGIN INSERT INTO search_index (rowid, name) VALUES (new.rowid, new.name); END",
+		"CREATE TRIGGER IF NOT EXISTS search_files_delete AFTER DELETE ON search_files BEGIN INSERT INTO search_index (search_index, rowid, name) VALUES ('delete', old.rowid, old.name); END",
+		"CREATE TABLE IF NOT EXISTS search_directories (mount TEXT NOT NULL, path TEXT NOT NULL, mtime INTEGER NOT NULL)",
+		"CREATE UNIQUE INDEX IF NOT EXISTS search_directories_index ON search_directories (mount ASC, path ASC)",
+		"CREATE TABLE IF NOT EXISTS revoked_ids (id TEXT NOT NULL, expires INTEGER NOT NULL)",
+		"CREATE UNIQUE INDEX IF NOT EXISTS revoked_ids_id_index ON revoked_ids (id ASC)",
+		"CREATE TABLE IF NOT EXISTS directory_sizes (device INTEGER NOT NULL, inode INTEGER NOT NULL, mtime INTEGER NOT NULL, own_used INTEGER NOT NULL, own_size INTEGER NOT NULL, own_files INTEGER NOT NULL, used INTEGER NOT NULL, size INTEGER NOT NULL, files INTEGER NOT NULL, PRIMARY KEY (device, inode)) WITHOUT ROWID"
+	],
+	# Mounts, paths and users are stored once, and referred to by integer from ids
+	[
+		"CREATE TABLE mounts (id INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+		"CREATE UNIQUE INDEX mounts_name_index ON mounts (name ASC)",
+		"CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+		"CREATE UNIQUE INDEX users_name_index ON users (name ASC)",
+		"CREATE TABLE paths (id INTEGER PRIMARY KEY, mount INTEGER NOT NULL, path NOT NULL)",
+		"CREATE UNIQUE INDEX paths_mount_path_index ON paths (mount ASC, path ASC)",
+		"INSERT INTO mounts (name) SELECT DISTINCT mount FROM ids",
+		"INSERT INTO users (name) SELECT DISTINCT user FROM ids WHERE user IS NOT NULL",
+		"INSERT INTO paths (mount, path) SELECT DISTINCT m.id, i.path FROM ids AS i JOIN mounts AS m ON m.name = i.mount",
+		"CREATE TABLE ids_compact (id TEXT NOT NULL PRIMARY KEY, expires INTEGER NOT NULL, user INTEGER NULL, download INTEGER NOT NULL, hits INTEGER NOT NULL, path INTEGER NOT NULL) WITHOUT ROWID",
+		"INSERT INTO ids_compact (id, expires, user, download, hits, path) SELECT i.id, i.expires, u.id, i.download, i.hits, p.id FROM ids AS i JOIN mounts AS m ON m.name = i.mount JOIN paths AS p ON p.mount = m.id AND p.path = i.path LEFT JOIN users AS u ON u.name = i.user",
+		"DROP TABLE ids",
+		"ALTER TABLE ids_compact RENAME TO ids",
+		"CREATE INDEX ids_path_user_download_index ON ids (path ASC, user ASC, download ASC)"
+	],
+	# Rows are keyed by the state their ID decodes to, along with the noise it carries
+	migrate_ids_to_states,
+	[
+		"CREATE INDEX ids_expires_index ON ids (expires ASC)"
+	]
+]
+
+setup_lock = threading.Lock()
+setup_done = False
+local = threading.local()
+
+def connect():
 	db = sqlite3.connect(database_path)
 
-	db.execute("PRAGMA journal_mode = WAL")
-	with db:
-		db.execute("CREATE TABLE IF NOT EXISTS ids (id TEXT NOT NULL, expires INTEGER NOT NULL, user TEXT NULL, download INTEGER NOT NULL, hits INTEGER NOT NULL, mount TEXT NOT NULL, path TEXT NOT NULL)")
-		db.execute("CREATE UNIQUE INDEX IF NOT EXISTS ids_id_index ON ids (id ASC)")
-		db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT NOT NULL, value)")
-		db.execute("CREATE UNIQUE INDEX IF NOT EXISTS state_key_index ON state (key ASC)")
+	db.execute("PRAGMA cache_size = {0}".format(configuration.database_cache_size))
+	db.execute("PRAGMA mmap_size = {0}".format(configuration.database_mmap_size))
+	db.execute("PRAGMA synchronous = {0}".format(configuration.database_synchronous))
+	db.execute("PRAGMA busy_timeout = {0}".format(configuration.database_busy_timeout))
 
 	return db
 
+def apply_migration(db, migration):
+	if callable(migration):
+		migration(db)
+	else:
+		for statement in migration:
+			db.execute(statement)
+
+def upgrade(db):
+	db.execute("PRAGMA journal_mode = WAL")
+
+	# Checked again once the write lock is held, in case another process upgraded in the meantime
+	db.execute("BEGIN IMMEDIATE")
+	try:
+		version = db.execute("PRAGMA user_version").fetchone()[0]
+		for migration in migrations[version:]:
+			apply_migration(db, migration)
+		db.execute("PRAGMA user_version = {0}".format(len(migrations)))
+		db.execute("COMMIT")
+	except:
+		db.execute("ROLLBACK")
+		raise
+
+def setup():
+	global setup_done
+
+	with setup_lock:
+		if setup_done:
+			return
+
+		db = connect()
+		try:
+			if db.execute("PRAGMA user_version").fetchone()[0] != len(migrations):
+				upgrade(db)
+		finally:
+			db.close()
+
+		setup_done = True
+
+def open_database():
+	setup()
+	return connect()
+
+def get_database():
+	# Connections are kept per thread, and never shared with a forked child
+	pid = os.getpid()
+	if getattr(local, 'pid', None) != pid:
+		local.db = open_database()
+		local.pid = pid
+
+	return local.db
+
 if __name__ == '__main__':
-	with open_database() as db:
-		pass
+	setup()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3.9
+import os
+import time
+import threading
+import collections
+import concurrent.futures
+import common
+import configuration
+
+assert(isinstance(configuration.listing_cache_entries, int))
+assert(all(isinstance(x, int) and x > 0 for x in configuration.scan_stat_threads.values()))
+
+# Paths are left out, as they are only the directory's joined with the name, and would take up most of the cache
+Entry = collections.namedtuple('Entry', ['name', 'is_directory', 'mtime', 'used', 'size', 'identity'])
+Listing = collections.namedtuple('Listing', ['identity', 'entries', 'statted'])
+
+# Directories modified less than this long ago are not cached, as further changes within the same timestamp granularity would go unnoticed
+racy_delay_ns = 2000000000
+
+lock = threading.Lock()
+listings = collections.OrderedDict()
+listings_size = 0
+flights = {}
+executors = {}
+
+def reset_after_fork():
+	# Threads don't survive fork, so neither do the scans they were running, nor the pools they belonged to
+	global lock
+
+	lock = threading.Lock()
+	flights.clear()
+	executors.clear()
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def get_identity(statbuf):
+	return (statbuf.st_dev, statbuf.st_ino, statbuf.st_mtime_ns)
+
+def get_executor(mount):
+	threads = configuration.scan_stat_threads.get(mount, 1)
+	if threads <= 1:
+		return None
+
+	with lock:
+		executor = executors.get(mount)
+		if not executor:
+			executor = executors[mount] = concurrent.futures.ThreadPoolExecutor(threads, 'stat-{0}'.format(mount))
+		return executor
+
+def stat_path(path):
+	try:
+		return os.stat(path)
+	except:
+		return None
+
+def make_entry(name, is_directory, buf):
+	if is_directory:
+		return Entry(name, True, int(buf.st_mtime) if buf else None, None, None, (buf.st_dev, buf.st_ino) if buf else None)
+	else:
+		return Entry(name, False, int(buf.st_mtime) if buf else None, buf.st_blocks * 512 if buf else None, buf.st_size if buf else None, None)
+
+def stat_entries(mount, fs_path, entries):
+	executor = get_executor(mount)
+	paths = (os.path.join(fs_path, entry.name) for entry in entries)
+	bufs = executor.map(stat_path, paths) if executor else map(stat_path, paths)
+
+	return [make_entry(entry.name, entry.is_directory, buf) for entry, buf in zip(entries, bufs)]
+
+def scan(mount, fs_path, need_stat):
+	result = []
+	with os.scandir(fs_path) as entries:
+		for entry in entries:
+			is_directory = False
+			try:
+				is_directory = entry.is_dir()
+			except:
+				pass
+
+			result.append(Entry(entry.name, is_directory, None, None, None, None))
+
+	if need_stat:
+		result = stat_entries(mount, fs_path, result)
+
+	return result
+
+def store(fs_path, listing):
+	global listings_size
+
+	old = listings.pop(fs_path, None)
+	if old:
+		listings_size -= len(old.entries)
+
+	if len(listing.entries) > configuration.listing_cache_entries:
+		return
+
+	listings[fs_path] = listing
+	listings_size += len(listing.entries)
+
+	while listings_size > configuration.listing_cache_entries:
+		_, old = listings.popitem(last=False)
+		listings_size -= len(old.entries)
+
+def invalidate(fs_path):
+	global listings_size
+
+	with lock:
+		old = listings.pop(fs_path, None)
+		if old:
+			listings_size -= len(old.entries)
+
+		# Scans already running may have read the directory before, they are neither joined nor stored anymore
+		for key in [key for key in flights if key[0] == fs_path]:
+			del flights[key]
+
+def get_entries(mount, fs_path, need_stat=True):
+	identity = get_identity(os.stat(fs_path))
+	key = (fs_path, identity, need_stat)
+
+	with lock:
+		listing = listings.get(fs_path)
+		if listing and listing.identity == identity:
+			if listing.statted or not need_stat:
+				listings.move_to_end(fs_path)
+				return listing.entries
+			unstatted = listing.entries
+		else:
+			unstatted = None
+
+		flight = flights.get(key)
+		if flight:
+			leader = False
+		else:
+			flight = flights[key] = concurrent.futures.Future()
+			leader = True
+
+	if not leader:
+		return flight.result()
+
+	try:
+		if unstatted is None:
+			entries = scan(mount, fs_path, need_stat)
+		else:
+			entries = stat_entries(mount, fs_path, unstatted)
+	except BaseException as e:
+		with lock:
+			if flights.get(key) is flight:
+				del flights[key]
+		flight.set_exception(e)
+		raise
+
+	with lock:
+		current = flights.get(key) is flight
+		if current:
+			del flights[key]
+		if current and time.time_ns() - identity[2] >= racy_delay_ns:
+			store(fs_path, Listing(identity, entries, need_stat))
+
+	flight.set_result(entries)
+	return entries
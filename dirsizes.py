@@ -0,0 +1,124 @@
+#!/usr/bin/env python3.9
+import os
+import contextlib
+import common
+import configuration
+import database
+
+batch_size = 1000
+
+class Node:
+	__slots__ = ('identity', 'mtime', 'own', 'totals', 'pending')
+
+	def __init__(self, identity, mtime, own, pending):
+		self.identity = identity
+		self.mtime = mtime
+		# (used, size, files) of the files directly inside, and of the whole subtree
+		self.own = own
+		self.totals = list(own)
+		self.pending = pending
+
+def visit(known, fs_path):
+	statbuf = os.stat(fs_path)
+	identity = (statbuf.st_dev, statbuf.st_ino)
+	previous = known.get(identity)
+	changed = not previous or previous[0] != statbuf.st_mtime_ns
+
+	used = 0
+	size = 0
+	files = 0
+	subdirectories = []
+
+	with os.scandir(fs_path) as entries:
+		for entry in entries:
+			try:
+				# Symbolic links are counted, but not followed, like du does
+				if entry.is_dir(follow_symlinks=False):
+					subdirectories.append(entry.path)
+					continue
+			except:
+				pass
+
+			if not changed:
+				continue
+
+			try:
+				buf = entry.stat(follow_symlinks=False)
+			except:
+				continue
+
+			used += buf.st_blocks * 512
+			size += buf.st_size
+			files += 1
+
+	own = (used, size, files) if changed else previous[1]
+	return Node(identity, statbuf.st_mtime_ns, own, subdirectories)
+
+def crawl_mount(db, known, seen, root):
+	rows = []
+
+	try:
+		stack = [visit(known, root)]
+	except OSError:
+		return
+
+	# Post-order walk, so a directory is complete once all of its children have been added to it
+	while stack:
+		node = stack[-1]
+		if node.pending:
+			try:
+				stack.append(visit(known, node.pending.pop()))
+			except OSError:
+				pass
+			continue
+
+		stack.pop()
+		if stack:
+			totals = stack[-1].totals
+			for i in range(len(totals)):
+				totals[i] += node.totals[i]
+
+		# Directories exported more than once are only stored the first time they are reached
+		if node.identity in seen:
+			continue
+		seen.add(node.identity)
+		rows.append(node.identity + (node.mtime,) + node.own + tuple(node.totals))
+		if len(rows) >= batch_size:
+			with db:
+				db.executemany('INSERT OR REPLACE INTO directory_sizes (device, inode, mtime, own_used, own_size, own_files, used, size, files) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+			rows = []
+
+	with db:
+		db.executemany('INSERT OR REPLACE INTO directory_sizes (device, inode, mtime, own_used, own_size, own_files, used, size, files) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+def crawl(verbose=False):
+	with contextlib.closing(database.open_database()) as db:
+		known = {}
+		for device, inode, mtime, own_used, own_size, own_files in db.execute('SELECT device, inode, mtime, own_used, own_size, own_files FROM directory_sizes'):
+			known[(device, inode)] = (mtime, (own_used, own_size, own_files))
+
+		seen = set()
+		for mount, root in configuration.exported_directories.items():
+			crawl_mount(db, known, seen, root)
+			if verbose:
+				print('{0}: {1} directories so far'.format(mount, len(seen)))
+
+		removed = [x for x in known.keys() if x not in seen]
+		with db:
+			db.executemany('DELETE FROM directory_sizes WHERE device = ? AND inode = ?', removed)
+
+		if verbose:
+			print('{0} directories removed'.format(len(removed)))
+
+def get_sizes(db, identities):
+	result = {}
+
+	for identity in identities:
+		row = db.execute('SELECT used, size, files FROM directory_sizes WHERE device = ? AND inode = ?', identity).fetchone()
+		if row:
+			result[identity] = row
+
+	return result
+
+if __name__ == '__main__':
+	crawl(True)
@@ -1,27 +1,31 @@
 #!/usr/bin/env python3.9
 import time
-import contextlib
 import urllib.parse
 import common
 import configuration
-import database
 import randomid
+import idcache
+import hits
 import page
 
 def handler(environ, writer, parameter):
 	if not randomid.validate_id(parameter):
 		return page.render_error_page(environ, writer, 400, 'Bad link.')
 
-	with contextlib.closing(database.open_database()) as db:
-		with db:
-			values = (parameter, int(time.time()))
+	if randomid.is_signed_id(parameter):
+		result = randomid.parse_signed_id(parameter)
+		if result and result[0] <= int(time.time()):
+			result = None
+	else:
+		parsed = randomid.parse_id(parameter)
+		if not parsed:
+			return page.render_error_page(environ, writer, 404, 'Bad or expired link.')
 
-			csr = db.execute('UPDATE ids SET hits = hits + 1 WHERE id = ? AND expires > ?', values)
-			if csr.rowcount:
-				csr = db.execute('SELECT expires, download, mount, path FROM ids WHERE id = ? AND expires > ?', values)
-				result = csr.fetchone()
-			else:
-				result = None
+		result = idcache.lookup(*parsed)
+
+		# Written to the database later, in batches
+		if result:
+			hits.record(parsed[0])
 
 	if not result:
 		return page.render_error_page(environ, writer, 404, 'Bad or expired link.')
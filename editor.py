@@ -1,11 +1,13 @@
 #!/usr/bin/env python3.9
 import time
-import contextlib
 import urllib.parse
 import common
 import configuration
 import database
 import randomid
+import linkstore
+import idcache
+import hits
 import page
 
 def get_ids_from_raw(environ, raw):
@@ -48,53 +50,93 @@ def get_parameters_from_post(environ):
 	ids = sorted(ids, key=str.lower)
 	return ids, delay, download
 
+def update_signed_id(db, id, delay, download):
+	entry = randomid.parse_signed_id(id)
+	if not entry:
+		return {
+			'valid': False,
+			'id': id
+		}
+
+	in_expires, in_download, in_mount, in_path = entry
+	del entry
+
+	out_expires = max(0, in_expires + delay)
+	out_download = in_download if download is None else bool(download)
+
+	# Signed links can't be changed in place, so a new one is handed out instead, and the old one is revoked if it would outlive it
+	out_id = id
+	if out_expires != in_expires or out_download != in_download:
+		out_id = randomid.make_signed_id(in_mount, in_path, out_expires, out_download)
+	if out_expires < in_expires:
+		randomid.revoke_ids_unlocked(db, [(id, in_expires)])
+
+	return {
+		'valid': True,
+		'id': out_id,
+		'expires': out_expires,
+		'download': out_download,
+		'hits': None,
+		'mount_path': (in_mount, in_path)
+	}
+
 def fetch_update_ids(ids, delay=0, download=None):
 	if not ids:
 		return []
 
 	result = []
-	with contextlib.closing(database.open_database()) as db:
-		with db:
-			for id in ids:
-				if not randomid.validate_id(id):
-					continue
+	links = []
+	db = database.get_database()
+	with db:
+		for id in ids:
+			if not randomid.validate_id(id):
+				continue
+
+			if randomid.is_signed_id(id):
+				result.append(update_signed_id(db, id, delay, download))
+				continue
+
+			parsed = randomid.parse_id(id)
+			if not parsed:
+				result.append({
+					'valid': False,
+					'id': id
+				})
+				continue
+
+			links.append((id, parsed))
 
-				entry = db.execute('SELECT expires, download, hits, mount, path FROM ids WHERE id = ?', (id,)).fetchone()
+	entries = linkstore.store.update([x[1] for x in links], delay, download)
 
-				if not entry:
-					result.append({
-						'valid': False,
-						'id': id
-					})
-					continue
+	for (id, parsed), entry in zip(links, entries):
+		if not entry:
+			result.append({
+				'valid': False,
+				'id': id
+			})
+			continue
 
-				if delay:
-					db.execute('UPDATE ids SET expires = MAX(0, expires + ?) WHERE id = ?', (delay, id))
-				if download is not None:
-					db.execute('UPDATE ids SET download = ? WHERE id = ?', (int(download), id))
+		in_expires, in_download, in_hits, in_mount, in_path = entry
+		del entry
 
-				in_expires, in_download, in_hits, in_mount, in_path = entry
-				del entry
+		if isinstance(in_path, bytes):
+			in_path = in_path.decode('utf-8', errors='surrogateescape')
 
-				in_expires = max(0, in_expires + delay)
-				if download is None:
-					in_download = bool(in_download)
-				else:
-					in_download = download
-				if isinstance(in_path, bytes):
-					in_path = in_path.decode('utf-8', errors='surrogateescape')
+		in_mount_path = (in_mount, in_path)
+		del in_mount, in_path
 
-				in_mount_path = (in_mount, in_path)
-				del in_mount, in_path
+		result.append({
+				'valid': True,
+				'id': id,
+				'expires': in_expires,
+				'download': in_download,
+				'hits': in_hits + hits.get_pending(parsed[0]),
+				'mount_path': in_mount_path
+			})
 
-				result.append({
-						'valid': True,
-						'id': id,
-						'expires': in_expires,
-						'download': in_download,
-						'hits': in_hits,
-						'mount_path': in_mount_path
-					})
+	# Only once committed, so that cached links are not refreshed from the old rows
+	if delay or download is not None:
+		idcache.invalidate([parsed[0] for (id, parsed), entry in zip(links, entries) if entry])
 
 	def get_sort_key(id):
 		mount_path = id.get('mount_path', ('', ''))
@@ -162,7 +204,10 @@ def handler(environ, writer, parameter):
 					else:
 						h.line('{0}', id['id'])
 					h.end('</td>')
-					h.line('<td class="hidden-xs hidden-sm">{0}</td>', str(id['hits']))
+					if id['hits'] is None:
+						h.line('<td class="hidden-xs hidden-sm">&ndash;</td>')
+					else:
+						h.line('<td class="hidden-xs hidden-sm">{0}</td>', str(id['hits']))
 					h.line('<td>{0}</td>', page.pretty_time(id['expires']))
 					h.begin('<td class="hidden-xs" style="font-size: 90%">')
 					if id['download']:
@@ -568,8 +568,12 @@ class Request(object):
         except:
             self.stderr.write(traceback.format_exc().encode('utf-8', errors='skip'))
             self.stderr.flush()
-            if not self.stdout.dataWritten:
-                self.server.error(self)
+            if self.stdout.dataWritten:
+                # Too late for an error page. Ending the request would
+                # have the web server pass the response on as complete.
+                self._conn.abort()
+                return
+            self.server.error(self)
 
             protocolStatus, appStatus = FCGI_REQUEST_COMPLETE, 0
 
@@ -705,6 +709,18 @@ class Connection(object):
         """
         rec.write(self._sock)
 
+    def abort(self):
+        """
+        Closes the socket without ending any Request, so that the web
+        server knows their responses were cut short. Ends this
+        Connection (run() returns).
+        """
+        self._keepGoing = False
+        try:
+            self._sock.close()
+        except:
+            pass
+
     def end_request(self, req, appStatus=0,
                     protocolStatus=FCGI_REQUEST_COMPLETE, remove=True):
         """
@@ -1184,7 +1200,8 @@ class BaseFCGIServer(object):
         """
         if self.debug:
             import cgitb
-            req.stdout.write(b'Content-Type: text/html\r\n\r\n' +
+            req.stdout.write(b'Status: 500 Internal Server Error\r\n'
+                             b'Content-Type: text/html\r\n\r\n' +
                              cgitb.html(sys.exc_info()).encode('utf-8', errors='replace'))
         else:
             errorpage = b"""<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
@@ -1195,5 +1212,6 @@ class BaseFCGIServer(object):
 <p>An unhandled exception was thrown by the application.</p>
 </body></html>
 """
-            req.stdout.write(b'Content-Type: text/html\r\n\r\n' +
+            req.stdout.write(b'Status: 500 Internal Server Error\r\n'
+                             b'Content-Type: text/html\r\n\r\n' +
                              errorpage)
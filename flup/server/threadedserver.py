@@ -54,6 +54,10 @@ class ThreadedServer(object):
 
         self._threadPool = ThreadPool(**kw)
 
+    def getCounters(self):
+        """Returns the counters of the thread pool."""
+        return self._threadPool.getCounters()
+
     def run(self, sock, timeout=1.0):
         """
         The main loop. Pass a socket that is ready to accept() client
@@ -73,6 +77,12 @@ class ThreadedServer(object):
         
         # Main loop.
         while self._keepGoing:
+            # While the pool is full, leave new connections waiting in the
+            # listen queue instead of accepting them only to close them.
+            if not self._threadPool.waitForRoom(timeout):
+                self._mainloopPeriodic()
+                continue
+
             try:
                 r, w, e = select.select([sock], [], [], timeout)
             except select.error as e:
@@ -96,8 +106,8 @@ class ThreadedServer(object):
 
                 # Hand off to Connection.
                 conn = self._jobClass(clientSock, addr, *self._jobArgs)
-                if not self._threadPool.addJob(conn, allowQueuing=False):
-                    # No thread left, immediately close the socket to hopefully
+                if not self._threadPool.addJob(conn):
+                    # No room left, immediately close the socket to hopefully
                     # indicate to the web server that we're at our limit...
                     # and to prevent having too many opened (and useless)
                     # files.
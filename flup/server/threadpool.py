@@ -28,64 +28,131 @@ __author__ = 'Allan Saddi <allan@saddi.com>'
 __version__ = '$Revision$'
 
 import sys
+import time
+import collections
 try:
     import _thread as thread  # py3
 except ImportError:
     import thread  # py2
 import threading
 
+Counters = collections.namedtuple('Counters', ['threads', 'active', 'idle',
+                                               'queued', 'rejected', 'started',
+                                               'queueWait', 'maxQueueWait'])
+
 class ThreadPool(object):
     """
     Thread pool that maintains the number of idle threads between
     minSpare and maxSpare inclusive. By default, there is no limit on
     the number of threads that can be started, but this can be controlled
     by maxThreads.
+
+    Jobs that find no idle thread wait in a queue, at most maxQueued of
+    them at a time. Callers can wait for room in the queue with
+    waitForRoom() before producing more jobs, and jobs that find no room
+    are rejected.
     """
-    def __init__(self, minSpare=1, maxSpare=5, maxThreads=0xffffffff):
+    def __init__(self, minSpare=1, maxSpare=5, maxThreads=0xffffffff,
+                 maxQueued=0xffffffff):
         self._minSpare = minSpare
         self._maxSpare = maxSpare
         self._maxThreads = max(minSpare, maxThreads)
-
-        self._lock = threading.Condition()
-        self._workQueue = []
+        self._maxQueued = maxQueued
+
+        lock = threading.Lock()
+        self._lock = threading.Condition(lock)
+        # Notified when a thread becomes idle, making room for a job.
+        self._room = threading.Condition(lock)
+        # Jobs along with the time they were queued at.
+        self._workQueue = collections.deque()
         self._idleCount = self._workerCount = maxSpare
 
+        self._rejectedCount = 0
+        self._startedCount = 0
+        self._queueWait = 0.0
+        self._maxQueueWait = 0.0
+
         # Start the minimum number of worker threads.
         for i in range(maxSpare):
             thread.start_new_thread(self._worker, ())
 
+    def _available(self):
+        """
+        Number of idle threads not spoken for by queued jobs. Negative
+        when jobs are waiting for a thread. Lock must be held.
+        """
+        return self._idleCount - len(self._workQueue)
+
+    def _hasRoom(self):
+        """Whether or not one more job can be added. Lock must be held."""
+        return self._available() > -self._maxQueued
+
+    def _spawnSpares(self):
+        """Maintain minimum number of spares. Lock must be held."""
+        while self._available() < self._minSpare and \
+              self._workerCount < self._maxThreads:
+            self._workerCount += 1
+            self._idleCount += 1
+            thread.start_new_thread(self._worker, ())
+
     def addJob(self, job, allowQueuing=True):
         """
         Adds a job to the work queue. The job object should have a run()
         method. If allowQueuing is True (the default), the job will be
-        added to the work queue regardless if there are any idle threads
-        ready. (The only way for there to be no idle threads is if maxThreads
-        is some reasonable, finite limit.)
+        added to the work queue as long as there is room in it, even if
+        there are no idle threads ready. (The only way for there to be no
+        idle threads is if maxThreads is some reasonable, finite limit.)
 
         Otherwise, if allowQueuing is False, and there are no more idle
         threads, the job will not be queued.
 
-        Returns True if the job was queued, False otherwise.
+        Returns True if the job was queued, False if it was rejected.
         """
         self._lock.acquire()
         try:
-            # Maintain minimum number of spares.
-            while self._idleCount < self._minSpare and \
-                  self._workerCount < self._maxThreads:
-                self._workerCount += 1
-                self._idleCount += 1
-                thread.start_new_thread(self._worker, ())
+            self._spawnSpares()
 
             # Hand off the job.
-            if self._idleCount or allowQueuing:
-                self._workQueue.append(job)
+            if self._available() > 0 or \
+               (allowQueuing and self._hasRoom()):
+                self._workQueue.append((job, time.monotonic()))
                 self._lock.notify()
                 return True
             else:
+                self._rejectedCount += 1
                 return False
         finally:
             self._lock.release()
 
+    def waitForRoom(self, timeout=None):
+        """
+        Waits until a job can be added to the work queue, for at most
+        timeout seconds if not None. Returns True if there is room,
+        False if the timeout expired first.
+        """
+        self._lock.acquire()
+        try:
+            return self._room.wait_for(self._hasRoom, timeout)
+        finally:
+            self._lock.release()
+
+    def getCounters(self):
+        """
+        Returns the number of threads, of those running a job and of
+        those idle, the number of jobs waiting in the queue, of jobs
+        rejected and of jobs started so far, as well as the total and
+        longest time, in seconds, jobs spent waiting in the queue.
+        """
+        self._lock.acquire()
+        try:
+            return Counters(self._workerCount,
+                            self._workerCount - self._idleCount,
+                            self._idleCount, len(self._workQueue),
+                            self._rejectedCount, self._startedCount,
+                            self._queueWait, self._maxQueueWait)
+        finally:
+            self._lock.release()
+
     def _worker(self):
         """
         Worker thread routine. Waits for a job, executes it, repeat.
@@ -96,11 +163,16 @@ class ThreadPool(object):
                 self._lock.wait()
 
             # We have a job to do...
-            job = self._workQueue.pop(0)
+            job, queued = self._workQueue.popleft()
 
             assert self._idleCount > 0
             self._idleCount -= 1
 
+            wait = time.monotonic() - queued
+            self._startedCount += 1
+            self._queueWait += wait
+            self._maxQueueWait = max(self._maxQueueWait, wait)
+
             self._lock.release()
 
             try:
@@ -112,10 +184,12 @@ class ThreadPool(object):
 
             self._lock.acquire()
 
-            if self._idleCount == self._maxSpare:
+            # Spares are counted past queued jobs, see _spawnSpares().
+            if self._available() >= self._maxSpare:
                 break # NB: lock still held
             self._idleCount += 1
-            assert self._idleCount <= self._maxSpare
+
+            self._room.notify()
 
         # Die off...
         assert self._workerCount > self._maxSpare
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3.9
 import os
 import time
+import heapq
 import json
 import shlex
-import contextlib
+import collections
 import urllib.parse
 import http.cookies
 import traceback
@@ -11,8 +12,22 @@ import common
 import configuration
 import database
 import randomid
+import linkstore
+import dircache
+import changes
+import volumes
+import search
+import dirsizes
+import idcache
 import page
 
+assert(configuration.download_reuse_minimum is None or isinstance(configuration.download_reuse_minimum, int))
+assert(configuration.browse_page_size is None or (isinstance(configuration.browse_page_size, int) and configuration.browse_page_size > 0))
+
+Window = collections.namedtuple('Window', ['offset', 'limit', 'total'])
+
+MediaType = collections.namedtuple('MediaType', ['type', 'icons', 'thumbnailable', 'animate', 'preview', 'playable', 'glyphicon'])
+
 def parameter_to_mount_path(parameter):
 	if not parameter:
 		return None
@@ -30,7 +45,7 @@ def mount_path_to_fspath(mount, path):
 	if not root:
 		return None
 
-	return os.path.join(root, path)
+	return os.path.join(root, path) if path else root
 
 def get_sort_info(cookies):
 	try:
@@ -53,6 +68,31 @@ def get_sort_info(cookies):
 
 	return (sort_key, sort_mode, sort_mixed)
 
+def get_list_mode(cookies):
+	try:
+		return bool(int(cookies['listmode'].value))
+	except:
+		return False
+
+def get_window_from_qs(parameters, default_limit):
+	try:
+		offset = max(0, int(parameters['offset'][0]))
+	except:
+		offset = 0
+
+	try:
+		limit = max(1, int(parameters['limit'][0]))
+	except:
+		limit = default_limit
+
+	return (offset, limit)
+
+def make_window_headers(window):
+	if window.limit is None:
+		return []
+
+	return [('X-Total-Count', str(window.total))]
+
 def get_uri_components_from_mount_path(mount_path):
 	components = configuration.browse_prefix[:-1].split('/')
 
@@ -82,249 +122,367 @@ def is_hidden_directory_name(name, is_editor):
 def is_hidden_file_name(name, is_editor):
 	return is_hidden_name(name, is_editor, configuration.hidden_file_names)
 
+def is_hidden_path(path, is_directory, is_editor):
+	components = path.split('/')
+	if not is_directory and is_hidden_file_name(components.pop(), is_editor):
+		return True
+
+	return any(is_hidden_directory_name(x, is_editor) for x in components)
+
+def make_path_value(mount_path, name):
+	path_value = ('{0}/{1}'.format(mount_path[1], name) if mount_path[1] else name)
+	try:
+		path_value.encode('utf-8')
+	except UnicodeEncodeError:
+		path_value = path_value.encode('utf-8', errors='surrogateescape')
+	return path_value
+
 def make_static_icons(name):
 	return {
 		'1x': '{0}icons/{1}.png'.format(configuration.static_prefix, name),
 		'2x': '{0}icons/{1}@2x.png'.format(configuration.static_prefix, name)
 	}
 
+drive_media_type = MediaType('drive', make_static_icons('drive'), False, False, False, False, 'hdd')
+directory_media_type = MediaType('directory', make_static_icons('folder'), False, False, False, False, 'folder-open')
+
+media_types = {
+	None: MediaType('file', make_static_icons('file'), False, False, False, False, 'file'),
+	'image': MediaType('file', None, True, False, True, False, 'picture'),
+	'audio': MediaType('file', make_static_icons('file'), False, False, False, True, 'music'),
+	'video': MediaType('file', None, True, True, False, True, 'facetime-video')
+}
+
+class Entry:
+	__slots__ = ('name', 'fs_path', 'media_type', 'hidden', 'id', 'mtime', 'used', 'size', 'base_uri', 'stale')
+
+	def __init__(self, name, fs_path, media_type, hidden, id, mtime, used, size, base_uri=None, stale=False):
+		self.name = name
+		self.fs_path = fs_path
+		self.media_type = media_type
+		self.hidden = hidden
+		self.id = id
+		self.mtime = mtime
+		self.used = used
+		self.size = size
+		self.base_uri = base_uri
+		self.stale = stale
+
+	@property
+	def type(self):
+		return self.media_type.type
+
+	@property
+	def uri(self):
+		if self.id:
+			return configuration.download_prefix + self.id
+		else:
+			return '{0}{1}/'.format(self.base_uri, urllib.parse.quote(self.name, encoding='utf-8', errors='surrogateescape'))
+
+	@property
+	def icons(self):
+		if self.media_type.icons:
+			return self.media_type.icons
+
+		base_thumbnail = configuration.thumbnail_prefix + self.id
+		return {
+			'1x': base_thumbnail,
+			'2x': '{0}@2x'.format(base_thumbnail),
+			'3x': '{0}@3x'.format(base_thumbnail),
+			'4x': '{0}@4x'.format(base_thumbnail)
+		}
+
+	@property
+	def lazy(self):
+		return self.media_type.thumbnailable
+
+	@property
+	def animate(self):
+		return self.media_type.animate
+
+	@property
+	def preview(self):
+		return self.media_type.preview
+
+	@property
+	def playable(self):
+		return self.media_type.playable
+
+	@property
+	def glyphicon(self):
+		return self.media_type.glyphicon
+
+	def to_dict(self, with_fs_path=True):
+		result = {
+			'name': self.name,
+			'type': self.type,
+			'hidden': self.hidden,
+			'id': self.id,
+			'mtime': self.mtime,
+			'used': self.used,
+			'size': self.size,
+			'uri': self.uri,
+			'icons': self.icons,
+			'lazy': self.lazy,
+			'animate': self.animate,
+			'preview': self.preview,
+			'playable': self.playable,
+			'glyphicon': self.glyphicon
+		}
+
+		if with_fs_path:
+			result['fs_path'] = self.fs_path
+		if self.media_type is drive_media_type:
+			result['stale'] = self.stale
+
+		return result
+
 def scan_root():
-	drive_icons = make_static_icons('drive')
+	base_uri = urllib.parse.quote(configuration.browse_prefix, encoding='utf-8', errors='surrogateescape')
 
 	result = []
 
 	for name, fs_path in configuration.exported_directories.items():
-		statbuf = None
-		try:
-			statbuf = os.statvfs(fs_path)
-		except:
-			pass
-
-		if statbuf:
-			used = (statbuf.f_blocks - statbuf.f_bfree) * statbuf.f_frsize
-			size = statbuf.f_blocks * statbuf.f_frsize
-		else:
-			used = None
-			size = None
-
-		result.append({
-			'id': None,
-			'name': name,
-			'fs_path': fs_path,
-			'type': 'drive',
-			'hidden': False,
-			'mtime': None,
-			'used': used,
-			'size': size,
-			'uri': urllib.parse.quote(make_uri_from_mount_path((name, ''), None, True), encoding='utf-8', errors='surrogateescape'),
-			'icons': drive_icons,
-			'lazy': False,
-			'animate': False,
-			'preview': False,
-			'playable': False,
-			'glyphicon': 'hdd'
-		})
+		usage = volumes.get_usage(name)
+		result.append(Entry(name, fs_path, drive_media_type, False, None, None, usage.used, usage.size, base_uri, usage.stale))
 
 	return result
 
-def scan_directory(mount_path, fs_path, sort_info, user, is_editor):
-	raw_result_directories = []
-	raw_result_files = []
-	with os.scandir(fs_path) as entries:
-		for entry in entries:
-			is_directory = False
-			try:
-				is_directory = entry.is_dir()
-			except:
-				pass
+def mint_signed_ids(items, now):
+	exact_expires = now + configuration.download_delay
+	expires = exact_expires
 
-			if is_directory:
-				if not is_hidden_directory_name(entry.name, is_editor):
-					raw_result_directories.append(entry)
-			else:
-				if not is_hidden_file_name(entry.name, is_editor):
-					raw_result_files.append(entry)
-
-	directory_icons = make_static_icons('folder')
-	file_icons = make_static_icons('file')
-
-	result_directories = []
-	result_files = []
-	expires = int(time.time()) + configuration.download_delay
-
-	with contextlib.closing(database.open_database()) as db:
-		with db:
-			for raw_entry in raw_result_directories:
-				buf = None
-				try:
-					buf = raw_entry.stat()
-				except:
-					pass
-
-				result_directories.append({
-					'name': raw_entry.name,
-					'fs_path': raw_entry.path,
-					'type': 'directory',
-					'hidden': is_hidden_directory_name(raw_entry.name, False),
-					'id': None,
-					'mtime': int(buf.st_mtime) if buf else None,
-					'used': None,
-					'size': None,
-					'uri': urllib.parse.quote(make_uri_from_mount_path(mount_path, raw_entry.name, True), encoding='utf-8', errors='surrogateescape'),
-					'icons': directory_icons,
-					'lazy': False,
-					'animate': False,
-					'preview': False,
-					'playable': False,
-					'glyphicon': 'folder-open'
-				})
-
-			states = randomid.get_state_range_unlocked(db, len(raw_result_files))
-			state_fetcher = iter(states)
-
-			for raw_entry in raw_result_files:
-				buf = None
-				try:
-					buf = raw_entry.stat()
-				except:
-					pass
-
-				state = next(state_fetcher)
-				if state >= randomid.invalid:
-					raise Exception('Exhausted ID space.')
-
-				unique_id = randomid.make_id(state)
-				path_value = ('{0}/{1}'.format(mount_path[1], raw_entry.name) if mount_path[1] else raw_entry.name)
-				try:
-					path_value.encode('utf-8')
-				except UnicodeEncodeError:
-					path_value = path_value.encode('utf-8', errors='surrogateescape')
-				db.execute('INSERT INTO ids (id, expires, user, download, hits, mount, path) VALUES (?, ?, ?, ?, ?, ?, ?)', (unique_id, expires, user, 0, 0, mount_path[0], path_value))
-
-				extension = os.path.splitext(raw_entry.name)[1].lower()
-				is_image = extension in configuration.image_extensions
-				is_audio = extension in configuration.audio_extensions
-				is_video = extension in configuration.video_extensions
-				is_thumbnailable = is_image or is_video
-
-				if is_thumbnailable:
-					base_thumbnail = configuration.thumbnail_prefix + unique_id
-					icons = {
-						'1x': base_thumbnail,
-						'2x': '{0}@2x'.format(base_thumbnail),
-						'3x': '{0}@3x'.format(base_thumbnail),
-						'4x': '{0}@4x'.format(base_thumbnail)
-					}
-				else:
-					icons = file_icons
-
-				result_files.append({
-					'name': raw_entry.name,
-					'fs_path': raw_entry.path,
-					'type': 'file',
-					'hidden': is_hidden_file_name(raw_entry.name, False),
-					'id': unique_id,
-					'mtime': int(buf.st_mtime) if buf else None,
-					'used': buf.st_blocks * 512 if buf else None,
-					'size': buf.st_size if buf else None,
-					'uri': configuration.download_prefix + unique_id,
-					'icons': icons,
-					'lazy': is_thumbnailable,
-					'animate': is_video,
-					'preview': is_image,
-					'playable': is_audio or is_video,
-					'glyphicon': 'picture' if is_image else 'music' if is_audio else 'facetime-video' if is_video else 'file'
-				})
+	# Rounded down to a common boundary, so the same links are handed out again until they are within download_reuse_minimum of expiring
+	if configuration.download_reuse_minimum is not None and configuration.download_delay > configuration.download_reuse_minimum:
+		expires -= expires % (configuration.download_delay - configuration.download_reuse_minimum)
+
+	revoked = randomid.load_revoked()
+	unique_ids = []
+
+	for mount, path_value in items:
+		id = randomid.make_signed_id(mount, path_value, expires, False)
+		if id in revoked:
+			id = randomid.make_signed_id(mount, path_value, exact_expires, False)
+		unique_ids.append(id)
+
+	return unique_ids
 
+def mint_ids(user, items, now):
+	if configuration.rid_mode == 'signed':
+		return mint_signed_ids(items, now)
+
+	reusable_expires = None if configuration.download_reuse_minimum is None else now + configuration.download_reuse_minimum
+	links = linkstore.store.mint(user, items, now + configuration.download_delay, reusable_expires)
+	return randomid.make_ids([x[0] for x in links], [x[1] for x in links])
+
+def get_raw_sort_key(sort_info):
 	if sort_info[0] == 'name':
-		sort_key = lambda x: x['name'].lower()
+		return lambda x: x.name.lower()
 	elif sort_info[0] == 'mtime' or sort_info[0] == 'used' or sort_info[0] == 'size':
-		sort_key = lambda x: (x[sort_info[0]] or 0, x['name'].lower())
+		return lambda x: (getattr(x, sort_info[0]) or 0, x.name.lower())
 	else:
-		sort_key = None
+		return None
+
+def select_sorted(entries, sort_key, reverse, count):
+	if count is None or count >= len(entries):
+		return sorted(entries, key=sort_key, reverse=reverse)
+	elif reverse:
+		return heapq.nlargest(count, entries, key=sort_key)
+	else:
+		return heapq.nsmallest(count, entries, key=sort_key)
+
+def scan_directory(mount_path, fs_path, sort_info, user, is_editor, offset=0, limit=None, need_stat=True, names=None):
+	raw_result_directories = []
+	raw_result_files = []
+	for entry in dircache.get_entries(mount_path[0], fs_path, need_stat or sort_info[0] != 'name'):
+		if names is not None and entry.name not in names:
+			continue
+		if entry.is_directory:
+			if not is_hidden_directory_name(entry.name, is_editor):
+				raw_result_directories.append(entry)
+		else:
+			if not is_hidden_file_name(entry.name, is_editor):
+				raw_result_files.append(entry)
+
+	total = len(raw_result_directories) + len(raw_result_files)
+	count = None if limit is None else offset + limit
+	sort_key = get_raw_sort_key(sort_info)
+
+	base_uri = urllib.parse.quote(make_uri_from_mount_path(mount_path, None, True), encoding='utf-8', errors='surrogateescape')
+
+	result = []
+	now = int(time.time())
+
+	db = database.get_database()
+	# Directory sizes come from the background crawl, and are missing for directories it has not reached yet
+	sizes = dirsizes.get_sizes(db, [entry.identity for entry in raw_result_directories if entry.identity])
+	if sizes:
+		raw_result_directories = [entry._replace(used=sizes[entry.identity][0], size=sizes[entry.identity][1]) if entry.identity in sizes else entry for entry in raw_result_directories]
 
 	if sort_info[2]:
-		result = result_directories + result_files
-		result.sort(key=sort_key, reverse=sort_info[1])
+		raw_result = select_sorted(raw_result_directories + raw_result_files, sort_key, sort_info[1], count)
 	else:
-		result_directories.sort(key=sort_key, reverse=sort_info[1])
-		result_files.sort(key=sort_key, reverse=sort_info[1])
-		result = result_directories + result_files
+		raw_result = select_sorted(raw_result_directories, sort_key, sort_info[1], count)
+		raw_result.extend(select_sorted(raw_result_files, sort_key, sort_info[1], None if count is None else max(0, count - len(raw_result))))
 
-	return result
+	raw_result = raw_result[offset:count]
+	del raw_result_directories, raw_result_files
 
-def subhandler_json(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message):
-	if not is_editor:
-		for entry in directory:
-			entry.pop('fs_path', None)
+	unique_ids = iter(mint_ids(user, [(mount_path[0], make_path_value(mount_path, raw_entry.name)) for raw_entry in raw_result if not raw_entry.is_directory], now))
+
+	for raw_entry in raw_result:
+		if raw_entry.is_directory:
+			result.append(Entry(raw_entry.name, os.path.join(fs_path, raw_entry.name), directory_media_type, is_hidden_directory_name(raw_entry.name, False), None, raw_entry.mtime, raw_entry.used, raw_entry.size, base_uri))
+			continue
 
-	json.dump(directory, writer, sort_keys=True)
+		media_type = media_types[common.media_kinds.get(os.path.splitext(raw_entry.name)[1].lower())]
+		result.append(Entry(raw_entry.name, os.path.join(fs_path, raw_entry.name), media_type, is_hidden_file_name(raw_entry.name, False), next(unique_ids), raw_entry.mtime, raw_entry.used, raw_entry.size))
 
-	return (200, [('Content-Type', 'application/json'), page.make_nocache_header(), page.make_content_disposition_header(name, '.json')])
+	return (result, total)
+
+def search_directory(mount_path, terms, sort_info, user, is_editor, offset=0, limit=None):
+	mount, scope = mount_path if mount_path else (None, '')
+	base_uri = urllib.parse.quote(make_uri_from_mount_path(mount_path, None, True), encoding='utf-8', errors='surrogateescape')
+
+	result = []
+	now = int(time.time())
+
+	db = database.get_database()
+	# The most relevant results, sorted like any other listing
+	raw_result = [x for x in search.find(db, terms, mount, scope) if not is_hidden_path(search.join_path(x.directory, x.name), x.is_directory, is_editor)]
+	total = len(raw_result)
+
+	# The index doesn't keep the identities directory sizes are stored under, so directories are looked up again
+	identities = {}
+	for raw_entry in raw_result:
+		fs_path = raw_entry.is_directory and mount_path_to_fspath(raw_entry.mount, search.join_path(raw_entry.directory, raw_entry.name))
+		if fs_path:
+			try:
+				buf = os.stat(fs_path)
+				identities[raw_entry] = (buf.st_dev, buf.st_ino)
+			except OSError:
+				pass
+	sizes = dirsizes.get_sizes(db, identities.values())
+	if sizes:
+		raw_result = [x._replace(used=sizes[identities[x]][0], size=sizes[identities[x]][1]) if identities.get(x) in sizes else x for x in raw_result]
+
+	count = None if limit is None else offset + limit
+	sort_key = get_raw_sort_key(sort_info)
+	if sort_info[2]:
+		raw_result = select_sorted(raw_result, sort_key, sort_info[1], count)
+	else:
+		raw_result_directories = [x for x in raw_result if x.is_directory]
+		raw_result = select_sorted(raw_result_directories, sort_key, sort_info[1], count) + select_sorted([x for x in raw_result if not x.is_directory], sort_key, sort_info[1], None if count is None else max(0, count - len(raw_result_directories)))
+	raw_result = raw_result[offset:count]
+
+	unique_ids = iter(mint_ids(user, [(x.mount, make_path_value((x.mount, x.directory), x.name)) for x in raw_result if not x.is_directory], now))
+
+	for raw_entry in raw_result:
+		path = search.join_path(raw_entry.directory, raw_entry.name)
+		fs_path = mount_path_to_fspath(raw_entry.mount, path)
+		hidden = is_hidden_path(path, raw_entry.is_directory, False)
+
+		# Names are shown relative to where the search was made from
+		if mount is None:
+			name = '{0}/{1}'.format(raw_entry.mount, path)
+		elif scope:
+			name = path[len(scope) + 1:]
+		else:
+			name = path
+
+		if raw_entry.is_directory:
+			result.append(Entry(name, fs_path, directory_media_type, hidden, None, raw_entry.mtime, raw_entry.used, raw_entry.size, base_uri))
+		else:
+			media_type = media_types[common.media_kinds.get(os.path.splitext(raw_entry.name)[1].lower())]
+			result.append(Entry(name, fs_path, media_type, hidden, next(unique_ids), raw_entry.mtime, raw_entry.used, raw_entry.size))
+
+	return (result, total)
+
+def subhandler_json(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window):
+	headers = [('Content-Type', 'application/json'), page.make_nocache_header(), page.make_content_disposition_header(name, '.json')] + make_window_headers(window)
+	page.begin_response(environ, 200, headers)
+
+	json.dump([entry.to_dict(is_editor) for entry in directory], writer, sort_keys=True)
+
+	return (200, headers)
+
+def subhandler_playlist(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window):
+	headers = [('Content-Type', 'application/vnd.apple.mpegurl'), page.make_nocache_header(), page.make_content_disposition_header(name, '.m3u8')] + make_window_headers(window)
+	page.begin_response(environ, 200, headers)
 
-def subhandler_playlist(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message):
 	writer.write('#EXTM3U\n')
 	for entry in directory:
-		if not entry['playable']:
+		if not entry.playable:
 			continue
 
-		writer.write('#EXTINF:0,{0}\n'.format(entry['name']))
-		writer.write('{0}\n'.format(page.uri_to_url(environ, entry['uri'])))
+		writer.write('#EXTINF:0,{0}\n'.format(entry.name))
+		writer.write('{0}\n'.format(page.uri_to_url(environ, entry.uri)))
 
-	return (200, [('Content-Type', 'application/vnd.apple.mpegurl'), page.make_nocache_header(), page.make_content_disposition_header(name, '.m3u8')])
+	return (200, headers)
+
+def subhandler_text(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window):
+	headers = [('Content-Type', 'text/plain; charset=utf-8'), page.make_nocache_header(), page.make_content_disposition_header(name, '.txt')] + make_window_headers(window)
+	page.begin_response(environ, 200, headers)
 
-def subhandler_text(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message):
 	for entry in directory:
-		writer.write('{0}\n'.format(page.uri_to_url(environ, entry['uri'])))
+		writer.write('{0}\n'.format(page.uri_to_url(environ, entry.uri)))
+
+	return (200, headers)
 
-	return (200, [('Content-Type', 'text/plain; charset=utf-8'), page.make_nocache_header(), page.make_content_disposition_header(name, '.txt')])
+def subhandler_wget(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window):
+	headers = [('Content-Type', 'application/x-sh'), page.make_nocache_header(), page.make_content_disposition_header(name, '.sh')] + make_window_headers(window)
+	page.begin_response(environ, 200, headers)
 
-def subhandler_wget(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message):
 	writer.write('#!/bin/sh\n')
 	for entry in directory:
-		if entry['type'] != 'file':
+		if entry.type != 'file':
 			continue
 
 		writer.write('\n')
-		writer.write('# {0}\n'.format(entry['name']))
-		writer.write('wget -c --content-disposition {0}\n'.format(shlex.quote(page.uri_to_url(environ, entry['uri']))))
+		writer.write('# {0}\n'.format(entry.name))
+		writer.write('wget -c --content-disposition {0}\n'.format(shlex.quote(page.uri_to_url(environ, entry.uri))))
 
-	return (200, [('Content-Type', 'application/x-sh'), page.make_nocache_header(), page.make_content_disposition_header(name, '.sh')])
+	return (200, headers)
+
+def subhandler_bbcode(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window):
+	headers = [('Content-Type', 'text/plain; charset=utf-8'), page.make_nocache_header(), page.make_content_disposition_header(name, '.txt')] + make_window_headers(window)
+	page.begin_response(environ, 200, headers)
 
-def subhandler_bbcode(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message):
 	for entry in directory:
-		if entry['type'] != 'file':
+		if entry.type != 'file':
 			continue
 
-		writer.write('[url={0}]{1}[/url]\n'.format(page.uri_to_url(environ, entry['uri']), entry['name']))
+		writer.write('[url={0}]{1}[/url]\n'.format(page.uri_to_url(environ, entry.uri), entry.name))
+
+	return (200, headers)
 
-	return (200, [('Content-Type', 'text/plain; charset=utf-8'), page.make_nocache_header(), page.make_content_disposition_header(name, '.txt')])
+def subhandler_bbcode_table(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window):
+	headers = [('Content-Type', 'text/plain; charset=utf-8'), page.make_nocache_header(), page.make_content_disposition_header(name, '.txt')] + make_window_headers(window)
+	page.begin_response(environ, 200, headers)
 
-def subhandler_bbcode_table(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message):
 	writer.write('[table]\n')
 	writer.write('[tr][td][b]Name[/b][/td][td][b]Size[/b][/td][td][b]Modified[/b][/td][/tr]\n')
 
 	for entry in directory:
-		if entry['type'] != 'file':
+		if entry.type != 'file':
 			continue
 
 		writer.write('[tr]\n')
-		writer.write('[td][url={0}]{1}[/url][/td]\n'.format(page.uri_to_url(environ, entry['uri']), entry['name']))
-		writer.write('[td]{0}[/td]\n'.format(page.pretty_size(entry['size'])))
-		writer.write('[td]{0}[/td]\n'.format(page.pretty_time(entry['mtime'])))
+		writer.write('[td][url={0}]{1}[/url][/td]\n'.format(page.uri_to_url(environ, entry.uri), entry.name))
+		writer.write('[td]{0}[/td]\n'.format(page.pretty_size(entry.size)))
+		writer.write('[td]{0}[/td]\n'.format(page.pretty_time(entry.mtime)))
 		writer.write('[/tr]\n')
 
 	writer.write('[/table]\n')
 
-	return (200, [('Content-Type', 'text/plain; charset=utf-8'), page.make_nocache_header(), page.make_content_disposition_header(name, '.txt')])
+	return (200, headers)
 
-def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message):
-	try:
-		list_mode = bool(int(cookies['listmode'].value))
-	except:
-		list_mode = False
+def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window, load=None):
+	list_mode = get_list_mode(cookies)
 
 	sort_info = get_sort_info(cookies)
+	terms = urllib.parse.parse_qs(environ['QUERY_STRING']).get('search', [''])[0]
+	query_suffix = '&' + urllib.parse.urlencode({'search': terms}) if terms else ''
 
 	theme_is_dark = page.themes[configuration.theme].dark
 
@@ -336,8 +494,14 @@ def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_edit
 			h.line('<link href="{0}gallery-{1}.css" rel="stylesheet">', configuration.static_prefix, 'dark' if theme_is_dark else 'light')
 
 	def navbar(h):
-		if any(map(lambda x: x['playable'], directory)):
-			h.line('<li><a href="?m3u"><span class="glyphicon glyphicon-play"></span> Play</a></li>')
+		h.begin('<li>')
+		h.begin('<form class="navbar-form" method="get">')
+		h.line('<input type="search" class="form-control" name="search" placeholder="Search" value="{0}">', terms)
+		h.end('</form>')
+		h.end('</li>')
+
+		if any(map(lambda x: x.playable, directory)):
+			h.line('<li><a href="?m3u{0}"><span class="glyphicon glyphicon-play"></span> Play</a></li>', query_suffix)
 
 		if is_editor:
 			h.begin('<li class="dropdown">')
@@ -405,23 +569,24 @@ def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_edit
 			h.begin('--><div class="archive_thumbnail">')
 
 			h.begin(*page.make_tag('a', [
-				('href', entry['uri']),
-				('class', 'archive_swipebox' if entry['preview'] else ''),
-				('title', entry['name'])]))
+				('href', entry.uri),
+				('class', 'archive_swipebox' if entry.preview else ''),
+				('title', entry.name)]))
 
 			img_classes = []
-			if entry['lazy']:
+			if entry.lazy:
 				img_classes.append('archive_lazy')
-			if entry['animate']:
+			if entry.animate:
 				img_classes.append('archive_video')
-			if entry['hidden']:
+			if entry.hidden:
 				img_classes.append('archive_hidden')
 
 			img_attributes = []
-			icon_1x = entry['icons']['1x']
-			icons_except_1x = sorted(filter(lambda x: x[0] != '1x', entry['icons'].items()))
+			icons = entry.icons
+			icon_1x = icons['1x']
+			icons_except_1x = sorted(filter(lambda x: x[0] != '1x', icons.items()))
 
-			if entry['animate']:
+			if entry.animate:
 				icon_1x_animated = icon_1x + '?animated'
 				icons_except_1x_animated = map(lambda x: (x[0], x[1] + '?animated'), icons_except_1x)
 			else:
@@ -433,30 +598,30 @@ def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_edit
 			srcset = ', '.join(map(lambda x: '{0} {1}'.format(x[1], x[0]), icons_except_1x))
 			srcset_animated = ', '.join(map(lambda x: '{0} {1}'.format(x[1], x[0]), icons_except_1x_animated))
 
-			if entry['lazy']:
+			if entry.lazy:
 				# Loading comes from: http://jxnblk.com/loading/
 				img_attributes.append(('src', configuration.static_prefix + ('loading-white.svg' if theme_is_dark else 'loading-gray.svg')))
 			else:
 				img_attributes.append(('src', src))
 				img_attributes.append(('srcset', srcset))
 
-			if entry['lazy'] or entry['animate']:
+			if entry.lazy or entry.animate:
 				img_attributes.append(('data-src', src))
 				img_attributes.append(('data-srcset', srcset))
 				img_attributes.append(('data-src-animated', src_animated))
 				img_attributes.append(('data-srcset-animated', srcset_animated))
 
 			img_attributes.append(('class', ' '.join(img_classes)))
-			img_attributes.append(('alt', entry['name']))
+			img_attributes.append(('alt', entry.name))
 
 			h.line(*page.make_tag('img', img_attributes))
 
 			h.end('</a>')
 
-			if is_editor and entry['id']:
-				h.line('<input type="checkbox" name="ids" value="{0}" style="display: none">', entry['id'])
+			if is_editor and entry.id:
+				h.line('<input type="checkbox" name="ids" value="{0}" style="display: none">', entry.id)
 
-			h.line('<div class="archive_name">{0}</div>', entry['name'])
+			h.line('<div class="archive_name">{0}</div>', entry.name)
 			h.end('</div><!--')
 
 		h.end('--></div>')
@@ -481,37 +646,43 @@ def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_edit
 			h.begin('<tr>')
 			h.begin('<td>')
 			if is_editor:
-				if entry['id']:
-					h.line('<input type="checkbox" name="ids" value="{0}" style="display: none; margin: 0px">', entry['id'])
+				if entry.id:
+					h.line('<input type="checkbox" name="ids" value="{0}" style="display: none; margin: 0px">', entry.id)
 				else:
 					h.line('<input type="checkbox" name="ids" disabled style="display: none; margin: 0px">')
-			h.line('<span class="killme glyphicon{0} glyphicon-{1}"></span>', ' archive_hidden' if entry['hidden'] else '', entry['glyphicon'])
+			h.line('<span class="killme glyphicon{0} glyphicon-{1}"></span>', ' archive_hidden' if entry.hidden else '', entry.glyphicon)
 			h.line('&nbsp;')
-			h.line('<a href="{0}">{1}</a>', entry['uri'], entry['name'])
+			h.line('<a href="{0}">{1}</a>', entry.uri, entry.name)
+			if entry.stale:
+				h.line('<span class="glyphicon glyphicon-time text-muted" title="Usage has not been refreshed recently."></span>')
+			elif not mount_path and entry.size is None:
+				h.line('<span class="glyphicon glyphicon-warning-sign text-muted" title="Usage is unavailable."></span>')
 			h.end('</td>')
 
 			info0 = None
 			info1 = None
 			if mount_path:
-				if entry['size'] is not None:
-					info0 = page.pretty_size(entry['size'])
-				if entry['mtime'] is not None:
-					info1 = page.pretty_time(entry['mtime'])
+				if entry.size is not None:
+					info0 = page.pretty_size(entry.size)
+				if entry.mtime is not None:
+					info1 = page.pretty_time(entry.mtime)
 			else:
-				if entry['used'] is not None:
-					info0 = page.pretty_size(entry['used'])
-				if entry['size'] is not None:
-					info1 = page.pretty_size(entry['size'])
+				if entry.used is not None:
+					info0 = page.pretty_size(entry.used)
+				if entry.size is not None:
+					info1 = page.pretty_size(entry.size)
+
+			info_class = ' text-muted' if entry.stale else ''
 
 			if info0 is None:
 				h.line('<td class="hidden-xs">&ndash;</td>')
 			else:
-				h.line('<td class="hidden-xs">{0}</td>', info0)
+				h.line('<td class="hidden-xs{0}">{1}</td>', info_class, info0)
 
 			if info1 is None:
 				h.line('<td class="hidden-xs hidden-sm hidden-md">&ndash;</td>')
 			else:
-				h.line('<td class="hidden-xs hidden-sm hidden-md">{0}</td>', info1)
+				h.line('<td class="hidden-xs hidden-sm hidden-md{0}">{1}</td>', info_class, info1)
 
 			h.end('</tr>')
 
@@ -532,8 +703,7 @@ def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_edit
 	def contents_editor(h):
 		h.begin('<div class="well">')
 
-		with contextlib.closing(database.open_database()) as db:
-			next_state = randomid.peek_state(db)
+		next_state = linkstore.store.peek_state()
 
 		invalid_state = randomid.invalid
 
@@ -558,17 +728,74 @@ def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_edit
 		h.line('<div class="progress-bar progress-bar-{0}" role="progressbar" aria-valuenow="{1}" aria-valuemin="0" aria-valuemax="100" style="width: {1}%"></div>', progress_type, percent_string)
 		h.end('</div>')
 
+		counters = idcache.get_counters()
+		lookups = counters.hits + counters.misses
+		hit_string = '%.2f' % (float(counters.hits) / float(lookups) * 100.0 if lookups else 0.0)
+
+		h.begin('<div class="row">')
+		h.line('<div class="col-xs-8 col-sm-8 "><strong>ID Cache</strong></div>')
+		h.line('<div class="col-xs-4 hidden-sm hidden-md hidden-lg text-right">{0} %</div>', hit_string)
+		h.line('<div class="hidden-xs col-sm-4 text-right">{0} hits, {1} misses <span class="text-muted">({2} %)</span></div>', str(counters.hits), str(counters.misses), hit_string)
+		h.end('</div>')
+		h.begin('<div class="row">')
+		h.line('<div class="col-xs-8 col-sm-8 ">Entries</div>')
+		h.line('<div class="col-xs-4 text-right">{0} / {1}</div>', str(counters.entries), str(configuration.id_cache_entries))
+		h.end('</div>')
+
+		# Only provided by the threaded server
+		get_server_counters = environ.get('archive.server_counters')
+		if get_server_counters:
+			counters = get_server_counters()
+			average_wait = counters.queueWait / counters.started if counters.started else 0.0
+
+			h.begin('<div class="row">')
+			h.line('<div class="col-xs-8 col-sm-8 "><strong>Server Threads</strong></div>')
+			h.line('<div class="col-xs-4 text-right">{0} active, {1} idle</div>', str(counters.active), str(counters.idle))
+			h.end('</div>')
+			h.begin('<div class="row">')
+			h.line('<div class="col-xs-8 col-sm-8 ">Queued</div>')
+			h.line('<div class="col-xs-4 text-right">{0} / {1}</div>', str(counters.queued), str(configuration.server_max_queued))
+			h.end('</div>')
+			h.begin('<div class="row">')
+			h.line('<div class="col-xs-8 col-sm-8 ">Rejected</div>')
+			h.line('<div class="col-xs-4 text-right">{0}</div>', str(counters.rejected))
+			h.end('</div>')
+			h.begin('<div class="row">')
+			h.line('<div class="col-xs-8 col-sm-8 ">Queue Wait</div>')
+			h.line('<div class="col-xs-4 text-right">{0} ms average, {1} ms max</div>', '%.1f' % (average_wait * 1000.0), '%.1f' % (counters.maxQueueWait * 1000.0))
+			h.end('</div>')
+
 		h.end("</div>")
 
 	def contents_message(h):
 		h.line('<p class="text-muted text-center">{0}</p>', message)
 
+	def contents_pager(h):
+		previous_offset = max(0, window.offset - window.limit)
+		next_offset = window.offset + window.limit
+
+		h.begin('<nav>')
+		h.begin('<ul class="pager">')
+		if window.offset:
+			h.line('<li class="previous"><a href="?offset={0}&amp;limit={1}{2}"><span aria-hidden="true">&larr;</span> Previous</a></li>', str(previous_offset), str(window.limit), query_suffix)
+		else:
+			h.line('<li class="previous disabled"><a><span aria-hidden="true">&larr;</span> Previous</a></li>')
+		h.line('<li><span>{0}&ndash;{1} of {2}</span></li>', str(min(window.offset + 1, window.total)), str(min(next_offset, window.total)), str(window.total))
+		if next_offset < window.total:
+			h.line('<li class="next"><a href="?offset={0}&amp;limit={1}{2}">Next <span aria-hidden="true">&rarr;</span></a></li>', str(next_offset), str(window.limit), query_suffix)
+		else:
+			h.line('<li class="next disabled"><a>Next <span aria-hidden="true">&rarr;</span></a></li>')
+		h.end('</ul>')
+		h.end('</nav>')
+
 	def contents_select(h):
 		breadcrumb(h)
 		if message:
 			contents_message(h)
 		else:
 			contents_entries(h)
+		if window.limit is not None and (window.offset or window.total > window.limit):
+			contents_pager(h)
 		if not mount_path and is_editor:
 			contents_editor(h)
 
@@ -587,17 +814,66 @@ def subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_edit
 		h.end('</script>')
 		h.line('<script src="{0}gallery.js"></script>', configuration.static_prefix)
 
+	def ready():
+		nonlocal directory, message, window
+		if load:
+			directory, message, window = load()
+
 	return page.render_page(
 		environ,
 		writer,
-		headers = [page.make_nocache_header(), page.make_content_disposition_header(name, '.html')],
-		title = 'Index of {0}'.format(make_uri_from_mount_path(mount_path)),
+		headers = [page.make_nocache_header(), page.make_content_disposition_header(name, '.html')] + make_window_headers(window),
+		title = 'Search for {0} in {1}'.format(terms, make_uri_from_mount_path(mount_path)) if terms else 'Index of {0}'.format(make_uri_from_mount_path(mount_path)),
 		link_cb = links,
 		navbar_cb = navbar,
 		content_cb = contents_select,
-		script_cb = scripts)
+		script_cb = scripts,
+		ready_cb = ready)
 
-def subhandler_error(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message):
+def subhandler_changes(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window):
+	if not fs_path:
+		return page.render_error_page(environ, writer, 400, 'Bad format.')
+
+	user = environ.get('REMOTE_USER')
+	sort_info = get_sort_info(cookies)
+	since = urllib.parse.parse_qs(environ['QUERY_STRING']).get('since', [None])[0]
+
+	# Taken before scanning, so changes happening meanwhile get reported again next time
+	token = changes.watch(fs_path)
+	changed = changes.get_changes(fs_path, since) if token and since else None
+
+	try:
+		if changed is None:
+			directory, total = scan_directory(mount_path, fs_path, sort_info, user, is_editor)
+			result = {
+				'token': token,
+				'reset': True,
+				'entries': [entry.to_dict(is_editor) for entry in directory]
+			}
+		else:
+			token, changed = changed
+			directory, total = scan_directory(mount_path, fs_path, sort_info, user, is_editor, names=changed)
+			present = set(entry.name for entry in directory)
+			result = {
+				'token': token,
+				'reset': False,
+				'added': [entry.to_dict(is_editor) for entry in directory if changed[entry.name] & changes.creation_mask],
+				'modified': [entry.to_dict(is_editor) for entry in directory if not changed[entry.name] & changes.creation_mask],
+				'removed': sorted(x for x in changed if x not in present and not is_hidden_directory_name(x, is_editor) and not is_hidden_file_name(x, is_editor))
+			}
+	except OSError as e:
+		if configuration.debug:
+			traceback.print_exc()
+		return page.render_error_page(environ, writer, 404, '{0}.'.format(e.strerror))
+
+	headers = [('Content-Type', 'application/json'), page.make_nocache_header(), page.make_content_disposition_header(name, '.json')]
+	page.begin_response(environ, 200, headers)
+
+	json.dump(result, writer, sort_keys=True)
+
+	return (200, headers)
+
+def subhandler_error(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window):
 	return page.render_error_page(environ, writer, 400, 'Bad format.')
 
 subhandlers = {
@@ -608,9 +884,13 @@ subhandlers = {
 	'wget': subhandler_wget,
 	'bbcode': subhandler_bbcode,
 	'bbtable': subhandler_bbcode_table,
-	'html': subhandler_html
+	'html': subhandler_html,
+	'changes': subhandler_changes
 }
 
+# Subhandlers showing sizes or modification times, requiring entries to be stat()ed
+stat_subhandlers = {subhandler_json, subhandler_bbcode_table}
+
 def handler(environ, writer, parameter):
 	mount_path = parameter_to_mount_path(parameter)
 
@@ -634,21 +914,44 @@ def handler(environ, writer, parameter):
 	except:
 		cookies = http.cookies.SimpleCookie()
 
-	message = None
-	if fs_path:
-		sort_info = get_sort_info(cookies)
-		try:
-			directory = scan_directory(mount_path, fs_path, sort_info, user, is_editor)
-		except OSError as e:
-			if configuration.debug:
-				traceback.print_exc()
+	parameters = urllib.parse.parse_qs(environ['QUERY_STRING'])
+	subhandler = page.match_in_qs(environ, subhandlers, subhandler_error)
+	offset, limit = get_window_from_qs(parameters, configuration.browse_page_size if subhandler is subhandler_html else None)
+	terms = parameters.get('search', [''])[0]
+
+	def load():
+		message = None
+		if subhandler is subhandler_changes:
 			directory = []
-			message = '{0}.'.format(e.strerror)
-	else:
-		directory = scan_root()
+			total = 0
+		elif terms:
+			directory, total = search_directory(mount_path, terms, get_sort_info(cookies), user, is_editor, offset, limit)
+			if not directory:
+				message = 'Nothing matches.'
+		elif fs_path:
+			sort_info = get_sort_info(cookies)
+			try:
+				need_stat = mount_path[0] not in configuration.scan_lazy_stat or subhandler in stat_subhandlers or (subhandler is subhandler_html and get_list_mode(cookies))
+				directory, total = scan_directory(mount_path, fs_path, sort_info, user, is_editor, offset, limit, need_stat)
+			except OSError as e:
+				if configuration.debug:
+					traceback.print_exc()
+				directory = []
+				total = 0
+				message = '{0}.'.format(e.strerror)
+		else:
+			directory = scan_root()
+			total = len(directory)
+			directory = directory[offset:None if limit is None else offset + limit]
 
-	if not message and not directory:
-		message = 'There is nothing here.'
+		if not message and not directory:
+			message = 'There is nothing here.'
 
-	subhandler = page.match_in_qs(environ, subhandlers, subhandler_error)
-	return subhandler(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message)
+		return (directory, message, Window(offset, limit, total))
+
+	# Unless paged, no header depends on the listing, so the head of the page is sent before scanning
+	if subhandler is subhandler_html and limit is None:
+		return subhandler_html(environ, cookies, writer, mount_path, fs_path, name, is_editor, None, None, Window(offset, limit, None), load)
+
+	directory, message, window = load()
+	return subhandler(environ, cookies, writer, mount_path, fs_path, name, is_editor, directory, message, window)
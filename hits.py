@@ -0,0 +1,95 @@
+#!/usr/bin/env python3.9
+import os
+import sys
+import dbm
+import time
+import atexit
+import sqlite3
+import threading
+import traceback
+import collections
+import common
+import configuration
+import linkstore
+
+assert(isinstance(configuration.download_hits_flush_interval, int) or isinstance(configuration.download_hits_flush_interval, float))
+
+# Errors of the link stores, such as a database locked for too long, after which flushing is attempted again
+flush_errors = (sqlite3.Error,) + dbm.error
+# Failed flushes in a row after which pending hits are dropped, so that they don't pile up forever
+max_flush_failures = 30
+
+lock = threading.Lock()
+started_pid = None
+# State of a link to the amount of hits not written to the database yet
+pending = collections.Counter()
+flush_failures = 0
+
+def reset_after_fork():
+	# Hits counted before are written by the parent
+	global lock, pending, flush_failures
+
+	lock = threading.Lock()
+	pending = collections.Counter()
+	flush_failures = 0
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def record(state):
+	start()
+
+	with lock:
+		pending[state] += 1
+
+def get_pending(state):
+	with lock:
+		return pending.get(state, 0)
+
+def flush():
+	global pending, flush_failures
+
+	with lock:
+		flushed = pending
+		pending = collections.Counter()
+
+	if not flushed:
+		return
+
+	try:
+		linkstore.store.add_hits(flushed)
+	except flush_errors:
+		with lock:
+			flush_failures += 1
+			# Kept for the next attempt, unless it has been failing for long
+			if flush_failures < max_flush_failures:
+				pending.update(flushed)
+				flushed = None
+			else:
+				flush_failures = 0
+		if flushed:
+			print('{0} download hits dropped after {1} failed flushes'.format(sum(flushed.values()), max_flush_failures), file=sys.stderr)
+		raise
+
+	with lock:
+		flush_failures = 0
+
+def run():
+	while True:
+		time.sleep(configuration.download_hits_flush_interval)
+		try:
+			flush()
+		except flush_errors:
+			traceback.print_exc()
+
+def start():
+	global started_pid
+
+	with lock:
+		# Threads don't survive fork, so a child starts its own
+		if started_pid == os.getpid():
+			return
+		started_pid = os.getpid()
+
+	threading.Thread(target=run, name='hits', daemon=True).start()
+
+atexit.register(flush)
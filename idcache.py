@@ -0,0 +1,113 @@
+#!/usr/bin/env python3.9
+import os
+import mmap
+import time
+import fcntl
+import struct
+import threading
+import collections
+import common
+import configuration
+import linkstore
+
+assert(isinstance(configuration.id_cache_entries, int))
+
+Counters = collections.namedtuple('Counters', ['hits', 'misses', 'entries'])
+
+lock = threading.Lock()
+# State to (noise, expires, download, mount, path)
+entries = collections.OrderedDict()
+hits = 0
+misses = 0
+# Bumped on every invalidation, so that a lookup racing with one does not store what it read before
+generation = 0
+
+# Bumped by whichever process invalidates, so that every other process drops its entries as well
+shared_path = os.path.join(configuration.database_directory, 'idcache.generation')
+shared_fd = None
+shared = None
+shared_seen = 0
+
+def open_shared_unlocked():
+	global shared_fd, shared
+
+	if shared is None:
+		shared_fd = os.open(shared_path, os.O_RDWR|os.O_CREAT, 0o0666)
+		if os.fstat(shared_fd).st_size < 8:
+			os.ftruncate(shared_fd, 8)
+		shared = mmap.mmap(shared_fd, 8)
+
+	return shared
+
+def check_shared_unlocked():
+	global generation, shared_seen
+
+	value = struct.unpack_from('Q', open_shared_unlocked())[0]
+	if value != shared_seen:
+		shared_seen = value
+		generation += 1
+		entries.clear()
+
+def reset_after_fork():
+	# A lock on the inherited descriptor would be shared with the parent
+	global lock, shared_fd, shared
+
+	lock = threading.Lock()
+	if shared is not None:
+		shared.close()
+		os.close(shared_fd)
+		shared_fd = None
+		shared = None
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def lookup(state, noise):
+	global hits, misses
+
+	now = int(time.time())
+
+	with lock:
+		check_shared_unlocked()
+		entry = entries.get(state)
+		if entry and entry[1] > now:
+			entries.move_to_end(state)
+			hits += 1
+			return entry[1:] if entry[0] == noise else None
+
+		misses += 1
+		if entry:
+			del entries[state]
+		current = generation
+
+	entry = linkstore.store.resolve(state, noise, now)
+	if not entry:
+		return None
+	entry = (noise,) + tuple(entry)
+
+	with lock:
+		if generation == current and configuration.id_cache_entries > 0:
+			entries[state] = entry
+			while len(entries) > configuration.id_cache_entries:
+				entries.popitem(last=False)
+
+	return entry[1:]
+
+def invalidate(states):
+	global generation, shared_seen
+
+	with lock:
+		check_shared_unlocked()
+		generation += 1
+		for state in states:
+			entries.pop(state, None)
+
+		fcntl.flock(shared_fd, fcntl.LOCK_EX)
+		try:
+			shared_seen = struct.unpack_from('Q', shared)[0] + 1
+			struct.pack_into('Q', shared, 0, shared_seen)
+		finally:
+			fcntl.flock(shared_fd, fcntl.LOCK_UN)
+
+def get_counters():
+	with lock:
+		return Counters(hits, misses, len(entries))
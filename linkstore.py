@@ -0,0 +1,491 @@
+#!/usr/bin/env python3.9
+import os
+import dbm
+import fcntl
+import time
+import pickle
+import importlib
+import threading
+import contextlib
+import common
+import configuration
+import database
+import randomid
+
+assert(configuration.link_store in ('sqlite', 'memory', 'dbm'))
+assert(isinstance(configuration.rid_state_block, int) and configuration.rid_state_block > 0)
+
+# Every store hands out links as (state, noise), and resolves them to (expires, download, mount, path)
+
+state_key = 'rid_state'
+
+# Seconds between purges of expired links by the memory store, which only the server process can do
+memory_purge_interval = 3600
+# Seconds of expiration times indexed together by the dbm store, which has no ordered keys to find expired links with
+expiry_bucket_size = 3600
+
+class StateBlock:
+	__slots__ = ('lock', 'states', 'pid')
+
+	# States reserved by this process but not handed out yet, lost on restart
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.states = range(0)
+		self.pid = None
+
+	def allocate(self, reserve, count):
+		with self.lock:
+			# A block inherited through fork is also owned by the parent
+			if self.pid != os.getpid():
+				self.states = range(0)
+				self.pid = os.getpid()
+
+			if count <= len(self.states):
+				result = self.states[:count]
+				self.states = self.states[count:]
+			else:
+				result = list(self.states)
+				missing = count - len(result)
+				reserved = reserve(max(missing, configuration.rid_state_block))
+				result.extend(reserved[:missing])
+				self.states = reserved[missing:]
+
+		if result and result[-1] >= randomid.invalid:
+			raise Exception('Exhausted ID space.')
+
+		return list(zip(result, randomid.make_noises(len(result))))
+
+	def peek(self, value):
+		# The unused part of our block is not used up yet, as long as nobody reserved anything past it
+		with self.lock:
+			if self.pid == os.getpid() and self.states and self.states.stop == value:
+				return self.states.start
+		return value
+
+def intern_name(db, table, name):
+	row = db.execute('SELECT id FROM {0} WHERE name = ?'.format(table), (name,)).fetchone()
+	if row:
+		return row[0]
+
+	# Ignored if another connection inserted it first
+	db.execute('INSERT OR IGNORE INTO {0} (name) VALUES (?)'.format(table), (name,))
+	return db.execute('SELECT id FROM {0} WHERE name = ?'.format(table), (name,)).fetchone()[0]
+
+def intern_path(db, mount_id, path_value):
+	row = db.execute('SELECT id FROM paths WHERE mount = ? AND path = ?', (mount_id, path_value)).fetchone()
+	if row:
+		return row[0]
+
+	db.execute('INSERT OR IGNORE INTO paths (mount, path) VALUES (?, ?)', (mount_id, path_value))
+	return db.execute('SELECT id FROM paths WHERE mount = ? AND path = ?', (mount_id, path_value)).fetchone()[0]
+
+class SQLiteStore:
+	__slots__ = ('block',)
+
+	def __init__(self):
+		self.block = StateBlock()
+
+	def reserve_states(self, count):
+		# Reserved on its own connection, so the reservation is committed even if the caller's transaction is rolled back
+		with contextlib.closing(database.open_database()) as db:
+			with db:
+				csr = db.execute('UPDATE state SET value = value + ? WHERE key = ?', (count, state_key))
+
+				if csr.rowcount:
+					last = db.execute('SELECT value FROM state WHERE key = ?', (state_key,)).fetchone()[0]
+				else:
+					db.execute('INSERT INTO state (key, value) VALUES(?, ?)', (state_key, count))
+					last = count
+
+		return range(last - count, last)
+
+	def peek_state(self):
+		db = database.get_database()
+		row = db.execute('SELECT value FROM state WHERE key = ?', (state_key,)).fetchone()
+		return self.block.peek(row[0] if row else 0)
+
+	def mint(self, user, items, expires, reusable_expires):
+		db = database.get_database()
+
+		# Committed before states are reserved, as that needs the write lock on another connection
+		with db:
+			user_id = None if user is None else intern_name(db, 'users', user)
+
+			mount_ids = {}
+			path_ids = []
+			for mount, path_value in items:
+				if mount not in mount_ids:
+					mount_ids[mount] = intern_name(db, 'mounts', mount)
+				path_ids.append(intern_path(db, mount_ids[mount], path_value))
+
+			if reusable_expires is None:
+				links = [None] * len(items)
+			else:
+				links = []
+				for path_id in path_ids:
+					links.append(db.execute('SELECT state, noise FROM ids WHERE path = ? AND user IS ? AND download = 0 AND expires > ? ORDER BY expires DESC LIMIT 1', (path_id, user_id, reusable_expires)).fetchone())
+
+		new_links = iter(self.block.allocate(self.reserve_states, links.count(None)))
+		rows = []
+
+		for i, path_id in enumerate(path_ids):
+			if links[i] is None:
+				links[i] = next(new_links)
+				rows.append(links[i] + (expires, user_id, 0, 0, path_id))
+
+		with db:
+			db.executemany('INSERT INTO ids (state, noise, expires, user, download, hits, path) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+		return links
+
+	def resolve(self, state, noise, now):
+		db = database.get_database()
+		return db.execute('SELECT i.expires, i.download, m.name, p.path FROM ids AS i JOIN paths AS p ON p.id = i.path JOIN mounts AS m ON m.id = p.mount WHERE i.state = ? AND i.noise = ? AND i.expires > ?', (state, noise, now)).fetchone()
+
+	def update(self, links, delay=0, download=None):
+		result = []
+
+		db = database.get_database()
+		with db:
+			for state, noise in links:
+				entry = db.execute('SELECT i.expires, i.download, i.hits, m.name, p.path FROM ids AS i JOIN paths AS p ON p.id = i.path JOIN mounts AS m ON m.id = p.mount WHERE i.state = ? AND i.noise = ?', (state, noise)).fetchone()
+				if not entry:
+					result.append(None)
+					continue
+
+				if delay:
+					db.execute('UPDATE ids SET expires = MAX(0, expires + ?) WHERE state = ?', (delay, state))
+				if download is not None:
+					db.execute('UPDATE ids SET download = ? WHERE state = ?', (int(download), state))
+
+				in_expires, in_download, in_hits, in_mount, in_path = entry
+				result.append((max(0, in_expires + delay), bool(in_download if download is None else download), in_hits, in_mount, in_path))
+
+		return result
+
+	def add_hits(self, counts):
+		db = database.get_database()
+		with db:
+			db.executemany('UPDATE ids SET hits = hits + ? WHERE state = ?', [(count, state) for state, count in counts.items()])
+
+	def purge_expired(self, now, limit):
+		db = database.get_database()
+		with db:
+			return db.execute('DELETE FROM ids WHERE state IN (SELECT state FROM ids WHERE expires <= ? LIMIT ?)', (now, limit)).rowcount
+
+class MemoryStore:
+	__slots__ = ('lock', 'block', 'state', 'links', 'reusable', 'purge_after')
+
+	# Nothing survives a restart, and nothing is shared between processes
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.block = StateBlock()
+		self.state = 0
+		# State to [noise, expires, download, hits, user, mount, path]
+		self.links = {}
+		# (user, mount, path) to the state of the last link handed out for it
+		self.reusable = {}
+		self.purge_after = 0
+
+	def reserve_states(self, count):
+		with self.lock:
+			self.state += count
+			return range(self.state - count, self.state)
+
+	def peek_state(self):
+		with self.lock:
+			value = self.state
+		return self.block.peek(value)
+
+	def mint(self, user, items, expires, reusable_expires):
+		links = []
+
+		# Cron runs in a process of its own, with a store of its own
+		now = int(time.time())
+		with self.lock:
+			purge = now >= self.purge_after
+			if purge:
+				self.purge_after = now + memory_purge_interval
+		if purge:
+			self.purge_expired(now, None)
+
+		with self.lock:
+			for mount, path_value in items:
+				state = self.reusable.get((user, mount, path_value))
+				link = self.links.get(state)
+				if reusable_expires is not None and link and not link[2] and link[1] > reusable_expires:
+					links.append((state, link[0]))
+				else:
+					links.append(None)
+
+		new_links = iter(self.block.allocate(self.reserve_states, links.count(None)))
+
+		with self.lock:
+			for i, (mount, path_value) in enumerate(items):
+				if links[i] is None:
+					links[i] = next(new_links)
+					self.links[links[i][0]] = [links[i][1], expires, False, 0, user, mount, path_value]
+					self.reusable[(user, mount, path_value)] = links[i][0]
+
+		return links
+
+	def resolve(self, state, noise, now):
+		with self.lock:
+			link = self.links.get(state)
+			if not link or link[0] != noise or link[1] <= now:
+				return None
+			return (link[1], link[2], link[5], link[6])
+
+	def update(self, links, delay=0, download=None):
+		result = []
+
+		with self.lock:
+			for state, noise in links:
+				link = self.links.get(state)
+				if not link or link[0] != noise:
+					result.append(None)
+					continue
+
+				link[1] = max(0, link[1] + delay)
+				if download is not None:
+					link[2] = bool(download)
+				result.append((link[1], link[2], link[3], link[5], link[6]))
+
+		return result
+
+	def add_hits(self, counts):
+		with self.lock:
+			for state, count in counts.items():
+				link = self.links.get(state)
+				if link:
+					link[3] += count
+
+	def purge_expired(self, now, limit):
+		with self.lock:
+			expired = [state for state, link in self.links.items() if link[1] <= now][:limit]
+			for state in expired:
+				link = self.links.pop(state)
+				key = (link[4], link[5], link[6])
+				if self.reusable.get(key) == state:
+					del self.reusable[key]
+
+		return len(expired)
+
+def get_reusable_key(user, mount, path_value):
+	# Not pickled, as pickling the same values doesn't always give the same bytes
+	return b'r' + repr((user, mount, path_value)).encode('utf-8')
+
+def get_bucket_key(bucket):
+	# Amount of chunks in the bucket, each holding the states of links expiring within it
+	return b'e' + bucket.to_bytes(8, 'big')
+
+def get_chunk_key(bucket, chunk):
+	return get_bucket_key(bucket) + chunk.to_bytes(4, 'big')
+
+class DbmStore:
+	__slots__ = ('path', 'lock', 'block', 'pid', 'lock_fd', 'module', 'handle', 'generation')
+
+	def __init__(self, path=None):
+		self.path = path or os.path.join(configuration.database_directory, 'links')
+		self.lock = threading.Lock()
+		self.block = StateBlock()
+		self.pid = None
+		self.lock_fd = None
+		self.module = None
+		self.handle = None
+		self.generation = None
+
+	@contextlib.contextmanager
+	def opened(self, write):
+		with self.lock:
+			# The lock file is not shared with a forked child, as that would share the lock as well
+			if self.pid != os.getpid():
+				self.pid = os.getpid()
+				self.lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+				self.handle = None
+				self.generation = None
+
+			fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+			try:
+				# Created beforehand, so that handles only have something to write back once written to
+				if self.module is None:
+					dbm.open(self.path, 'c').close()
+					self.module = importlib.import_module(dbm.whichdb(self.path))
+
+				# Reopened whenever another process wrote in the meantime, as dbm modules cache what they read
+				generation = os.pread(self.lock_fd, 8, 0)
+				if self.handle is not None and generation != self.generation:
+					self.handle.close()
+					self.handle = None
+				if self.handle is None:
+					# Locking is already taken care of, and gdbm's own would keep other processes out while a handle is kept open
+					self.handle = self.module.open(self.path, 'wu' if self.module.__name__ == 'dbm.gnu' else 'w')
+
+				try:
+					yield self.handle
+				finally:
+					if write:
+						# Closed rather than kept, as some modules write back their whole index when closed, stale or not
+						self.handle.close()
+						self.handle = None
+						generation = (int.from_bytes(generation, 'little') + 1).to_bytes(8, 'little')
+						os.pwrite(self.lock_fd, generation, 0)
+					self.generation = generation
+			finally:
+				fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+	def reserve_states(self, count):
+		with self.opened(True) as handle:
+			last = int(handle.get(b'state', b'0')) + count
+			handle[b'state'] = str(last).encode('ascii')
+
+		return range(last - count, last)
+
+	def peek_state(self):
+		with self.opened(False) as handle:
+			value = int(handle.get(b'state', b'0'))
+		return self.block.peek(value)
+
+	def mint(self, user, items, expires, reusable_expires):
+		links = []
+		keys = [get_reusable_key(user, mount, path_value) for mount, path_value in items]
+
+		with self.opened(False) as handle:
+			for key in keys:
+				state = handle.get(key)
+				link = state and handle.get(b'l' + state)
+				link = link and pickle.loads(link)
+				if reusable_expires is not None and link and not link[2] and link[1] > reusable_expires:
+					links.append((int.from_bytes(state, 'big'), link[0]))
+				else:
+					links.append(None)
+
+		new_links = iter(self.block.allocate(self.reserve_states, links.count(None)))
+		states = []
+
+		with self.opened(True) as handle:
+			for i, (mount, path_value) in enumerate(items):
+				if links[i] is None:
+					links[i] = next(new_links)
+					state = links[i][0].to_bytes(8, 'big')
+					handle[b'l' + state] = pickle.dumps((links[i][1], expires, False, 0, user, mount, path_value), 4)
+					handle[keys[i]] = state
+					states.append(state)
+
+			if states:
+				self.index_unlocked(handle, expires, states)
+
+		return links
+
+	def index_unlocked(self, handle, expires, states):
+		# Written as a new chunk, so that minting never rewrites what is already indexed
+		bucket = expires // expiry_bucket_size
+		bucket_key = get_bucket_key(bucket)
+		count = int(handle.get(bucket_key, b'0'))
+		handle[get_chunk_key(bucket, count)] = b''.join(states)
+		handle[bucket_key] = str(count + 1).encode('ascii')
+
+		oldest = handle.get(b'oldest')
+		if oldest is None or bucket < int(oldest):
+			handle[b'oldest'] = str(bucket).encode('ascii')
+
+	def resolve(self, state, noise, now):
+		with self.opened(False) as handle:
+			link = handle.get(b'l' + state.to_bytes(8, 'big'))
+
+		link = link and pickle.loads(link)
+		if not link or link[0] != noise or link[1] <= now:
+			return None
+		return (link[1], link[2], link[5], link[6])
+
+	def update(self, links, delay=0, download=None):
+		result = []
+
+		with self.opened(True) as handle:
+			for state, noise in links:
+				key = b'l' + state.to_bytes(8, 'big')
+				link = handle.get(key)
+				link = link and list(pickle.loads(link))
+				if not link or link[0] != noise:
+					result.append(None)
+					continue
+
+				link[1] = max(0, link[1] + delay)
+				if download is not None:
+					link[2] = bool(download)
+				handle[key] = pickle.dumps(tuple(link), 4)
+				result.append((link[1], link[2], link[3], link[5], link[6]))
+
+		return result
+
+	def add_hits(self, counts):
+		with self.opened(True) as handle:
+			for state, count in counts.items():
+				key = b'l' + state.to_bytes(8, 'big')
+				link = handle.get(key)
+				if link:
+					link = pickle.loads(link)
+					handle[key] = pickle.dumps(link[:3] + (link[3] + count,) + link[4:], 4)
+
+	def purge_expired(self, now, limit):
+		deleted = 0
+		# Buckets before this one only hold links that have expired, unless they were extended since
+		last = now // expiry_bucket_size
+
+		with self.opened(True) as handle:
+			bucket = int(handle.get(b'oldest', str(last).encode('ascii')))
+
+			while bucket < last and deleted < limit:
+				bucket_key = get_bucket_key(bucket)
+				count = int(handle.get(bucket_key, b'0'))
+				if not count:
+					if bucket_key in handle:
+						del handle[bucket_key]
+					bucket += 1
+					continue
+
+				chunk_key = get_chunk_key(bucket, count - 1)
+				states = handle.get(chunk_key, b'')
+				extended = {}
+
+				# Taken from the end, so that whatever is left over for the next batch stays in place
+				while states and deleted < limit:
+					state = states[-8:]
+					states = states[:-8]
+					link = handle.get(b'l' + state)
+					if not link:
+						continue
+
+					link = pickle.loads(link)
+					if link[1] > now:
+						extended.setdefault(link[1], []).append(state)
+						continue
+
+					del handle[b'l' + state]
+					deleted += 1
+
+					reusable_key = get_reusable_key(*link[4:])
+					if handle.get(reusable_key) == state:
+						del handle[reusable_key]
+
+				for expires, extended_states in extended.items():
+					self.index_unlocked(handle, expires, extended_states)
+
+				if states:
+					handle[chunk_key] = states
+				else:
+					if chunk_key in handle:
+						del handle[chunk_key]
+					handle[bucket_key] = str(count - 1).encode('ascii')
+
+			# Extended links were indexed in later buckets only
+			handle[b'oldest'] = str(bucket).encode('ascii')
+
+		return deleted
+
+stores = {
+	'sqlite': SQLiteStore,
+	'memory': MemoryStore,
+	'dbm': DbmStore
+}
+
+store = stores[configuration.link_store]()
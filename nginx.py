@@ -12,6 +12,13 @@ nginx_conf = 'nginx.conf'
 archive_htpasswd = 'archive.htpasswd'
 archive_editor_htpasswd = 'archive_editor.htpasswd'
 
+def fastcgi_pass(i):
+	if configuration.server_mode == 'asyncio':
+		i.line('fastcgi_pass archive;')
+		i.line('fastcgi_keep_conn on;')
+	else:
+		i.line('fastcgi_pass unix:{0};', common.socket_path)
+
 def generate_configuration(root, stream):
 	i = indent.Indenter(stream)
 
@@ -33,6 +40,14 @@ def generate_configuration(root, stream):
 	i.line('#gzip on;')
 	i.line()
 
+	# Connections are kept open between requests, as they cost next to nothing to the server when idle
+	if configuration.server_mode == 'asyncio':
+		i.begin('upstream archive {{')
+		i.line('server unix:{0};', common.socket_path)
+		i.line('keepalive 64;')
+		i.end('}}')
+		i.line()
+
 	i.begin('server {{')
 	i.line('listen 80;')
 	i.line('server_name localhost;')
@@ -50,7 +65,7 @@ def generate_configuration(root, stream):
 	i.line('auth_basic "{0} Editor";', configuration.name)
 	i.line('auth_basic_user_file {0};', os.path.join(root, archive_editor_htpasswd))
 	i.line()
-	i.line('fastcgi_pass unix:{0};', common.socket_path)
+	fastcgi_pass(i)
 	i.line('include fastcgi_params;')
 	i.line('fastcgi_param REMOTE_USER $remote_user;')
 	i.line('fastcgi_param archive.module editor;')
@@ -61,7 +76,7 @@ def generate_configuration(root, stream):
 	i.line('auth_basic "{0}";', configuration.name)
 	i.line('auth_basic_user_file {0};', os.path.join(root, archive_htpasswd))
 	i.line()
-	i.line('fastcgi_pass unix:{0};', common.socket_path)
+	fastcgi_pass(i)
 	i.line('include fastcgi_params;')
 	i.line('fastcgi_param REMOTE_USER $remote_user;')
 	i.line('fastcgi_param archive.module gallery;')
@@ -69,7 +84,7 @@ def generate_configuration(root, stream):
 	i.line()
 
 	i.begin('location {0} {{', configuration.download_prefix)
-	i.line('fastcgi_pass unix:{0};', common.socket_path)
+	fastcgi_pass(i)
 	i.line('include fastcgi_params;')
 	i.line('fastcgi_param archive.module download;')
 	i.end('}}')
@@ -86,7 +101,7 @@ def generate_configuration(root, stream):
 	i.line()
 
 	i.begin('location {0} {{', configuration.thumbnail_prefix)
-	i.line('fastcgi_pass unix:{0};', common.socket_path)
+	fastcgi_pass(i)
 	i.line('include fastcgi_params;')
 	i.line('fastcgi_param archive.module thumbnail;')
 	i.end('}}')
@@ -104,8 +104,17 @@ def pretty_size(value):
 	else:
 		return '%.2fT' % (value / 1099511627776.0)
 
-def render_page(environ, writer, code=200, headers=[], title=configuration.name, link_cb=None, navbar_cb=None, content_cb=None, script_cb=None):
+def begin_response(environ, code, headers):
+	# From then on, output is sent as it is written instead of once the handler returns
+	response = environ.get('archive.response')
+	if response:
+		response.begin(code, headers)
+
+def render_page(environ, writer, code=200, headers=[], title=configuration.name, link_cb=None, navbar_cb=None, content_cb=None, script_cb=None, ready_cb=None):
 	theme = themes[configuration.theme]
+	headers = [('Content-Type', 'text/html; charset=utf-8')] + headers
+	begin_response(environ, code, headers)
+
 	h = HtmlIndenter(writer)
 	h.line('<!doctype html>')
 	h.begin('<html lang="en">')
@@ -117,6 +126,12 @@ def render_page(environ, writer, code=200, headers=[], title=configuration.name,
 	if link_cb:
 		link_cb(h)
 	h.end('</head>')
+
+	# Sent right away, so that stylesheets are fetched while the rest is prepared
+	writer.flush()
+	if ready_cb:
+		ready_cb()
+
 	h.begin('<body>')
 	h.begin('<nav class="navbar navbar-{0}">', 'inverse' if configuration.theme_inverse_navbar else 'default')
 	h.begin('<div class="container-fluid">')
@@ -148,7 +163,7 @@ def render_page(environ, writer, code=200, headers=[], title=configuration.name,
 	h.end('</body>')
 	h.end('</html>')
 
-	return (code, [('Content-Type', 'text/html; charset=utf-8')] + headers)
+	return (code, headers)
 
 def render_error_page(environ, writer, code, message):
 	h = HtmlIndenter(writer)
@@ -2,8 +2,13 @@
 import os
 import sys
 import math
+import time
+import hmac
+import base64
+import struct
+import hashlib
 import random
-import contextlib
+import threading
 import common
 import database
 import configuration
@@ -12,6 +17,12 @@ bits_state = int(configuration.rid_bits_state)
 bits_noise = int(configuration.rid_bits_noise)
 
 assert(bits_state > 0)
+# States and noise are stored as SQLite integers
+assert(bits_state <= 63 and bits_noise <= 63)
+assert(configuration.rid_mode in ('random', 'signed'))
+assert(configuration.rid_signing_key is None or isinstance(configuration.rid_signing_key, bytes))
+assert(configuration.rid_mode != 'signed' or configuration.rid_signing_key)
+assert(isinstance(configuration.rid_revoked_refresh, int) or isinstance(configuration.rid_revoked_refresh, float))
 
 if configuration.rid_python2_random:
 	generator = random.Random()
@@ -42,35 +53,70 @@ else:
 
 length = int(math.ceil(math.log(2 ** (bits_state + bits_noise), len(symbols))))
 
-state_key = 'rid_state'
-
 del generator
 
-def peek_state(db):
-	row = db.execute('SELECT value FROM state WHERE key = ?', (state_key,)).fetchone()
-	return row[0] if row else 0
+noise_bytes = math.ceil(bits_noise / 8)
 
-def get_state_range_unlocked(db, count):
-	if not count:
-		return []
+def make_byte_tables(positions):
+	# For every byte of the input, maps each of its 256 values to where its bits end up once swizzled
+	tables = []
+	for offset in range(0, len(positions), 8):
+		table = []
+		for value in range(256):
+			swizzled = 0
+			for bit, position in enumerate(positions[offset:offset + 8]):
+				if value & (1 << bit):
+					swizzled |= 1 << position
+			table.append(swizzled)
+		tables.append(table)
+	return tables
 
-	csr = db.execute('UPDATE state SET value = value + ? WHERE key = ?', (count, state_key))
+state_tables = make_byte_tables([swizzle.index(x) for x in range(bits_state)])
+noise_tables = make_byte_tables([i for i in range(len(swizzle)) if swizzle[i] < 0])
+state_bytes = len(state_tables)
 
-	if csr.rowcount:
-		last = db.execute('SELECT value FROM state WHERE key = ?', (state_key,)).fetchone()[0]
-	else:
-		db.execute('INSERT INTO state (key, value) VALUES(?, ?)', (state_key, count))
-		last = count
+# Every pair of symbols, so that two are produced per division
+pair_base = len(symbols) ** 2
+pair_symbols = [symbols[x % len(symbols)] + symbols[x // len(symbols)] for x in range(pair_base)]
+
+symbol_values = {x: i for i, x in enumerate(symbols)}
+
+def make_unswizzle_tables(sources):
+	# For every byte of a swizzled value, maps each of its 256 values back to the bits they came from
+	tables = []
+	for offset in range(0, len(sources), 8):
+		table = []
+		for value in range(256):
+			unswizzled = 0
+			for bit, source in enumerate(sources[offset:offset + 8]):
+				if source is not None and value & (1 << bit):
+					unswizzled |= 1 << source
+			table.append(unswizzled)
+		tables.append(table)
+	return tables
+
+noise_positions = [i for i in range(len(swizzle)) if swizzle[i] < 0]
+unswizzle_state_tables = make_unswizzle_tables([x if x >= 0 else None for x in swizzle])
+unswizzle_noise_tables = make_unswizzle_tables([noise_positions.index(i) if swizzle[i] < 0 else None for i in range(len(swizzle))])
+swizzled_bytes = len(unswizzle_state_tables)
 
-	return range(last - count, last)
+# Signed IDs carry their own expiry, disposition, mount and path, so they resolve without a database lookup
+signed_prefix = '~'
+signed_header = struct.Struct('>IBB')
+signed_mac_length = 12
 
-def get_state_range(db, count):
-	with db:
-		return get_state_range_unlocked(db, count)
+# Derived from the configured key, so that the same key is never used both to sign and to encrypt
+signing_key = configuration.rid_signing_key and hmac.new(configuration.rid_signing_key, b'sign', 'sha256').digest()
+encryption_key = configuration.rid_signing_key and hmac.new(configuration.rid_signing_key, b'encrypt', 'sha256').digest()
 
-def make_id(state):
+revoked_lock = threading.Lock()
+revoked = frozenset()
+revoked_loaded = None
+
+def make_id(state, noise=None):
 	state ^= inverter
-	noise = int.from_bytes(os.urandom(math.ceil(bits_noise / 8)), 'little')
+	if noise is None:
+		noise = int.from_bytes(os.urandom(noise_bytes), 'little')
 	swizzled = 0
 
 	for i in range(0, len(swizzle)):
@@ -89,7 +135,129 @@ def make_id(state):
 
 	return ''.join(result)
 
+def make_noises(count):
+	pool = os.urandom(noise_bytes * count)
+	mask = (1 << bits_noise) - 1
+	return [int.from_bytes(pool[i * noise_bytes:(i + 1) * noise_bytes], 'little') & mask for i in range(count)]
+
+def make_ids(states, noises=None):
+	if noises is None:
+		states = list(states)
+		noises = make_noises(len(states))
+	noises = (x.to_bytes(noise_bytes, 'little') for x in noises)
+
+	pairs = length // 2
+	result = []
+
+	for state, noise in zip(states, noises):
+		swizzled = 0
+		for table, value in zip(state_tables, ((state ^ inverter) & (invalid - 1)).to_bytes(state_bytes, 'little')):
+			swizzled |= table[value]
+		for table, value in zip(noise_tables, noise):
+			swizzled |= table[value]
+
+		parts = []
+		for i in range(pairs):
+			swizzled, index = divmod(swizzled, pair_base)
+			parts.append(pair_symbols[index])
+		if length % 2:
+			parts.append(symbols[swizzled % len(symbols)])
+
+		result.append(''.join(parts))
+
+	return result
+
+def parse_id(id):
+	if len(id) != length:
+		return None
+
+	swizzled = 0
+	for symbol in reversed(id):
+		index = symbol_values.get(symbol)
+		if index is None:
+			return None
+		swizzled = swizzled * len(symbols) + index
+
+	if swizzled >> len(swizzle):
+		return None
+
+	state = 0
+	noise = 0
+	for state_table, noise_table, value in zip(unswizzle_state_tables, unswizzle_noise_tables, swizzled.to_bytes(swizzled_bytes, 'little')):
+		state |= state_table[value]
+		noise |= noise_table[value]
+
+	return (state ^ inverter, noise)
+
+def get_signature(payload):
+	return hmac.new(signing_key, payload, 'sha256').digest()[:signed_mac_length]
+
+def apply_keystream(signature, data):
+	# The signature of the payload doubles as its nonce, so that links to different files never share a keystream
+	keystream = hashlib.shake_256(encryption_key + signature).digest(len(data))
+	return (int.from_bytes(data, 'big') ^ int.from_bytes(keystream, 'big')).to_bytes(len(data), 'big')
+
+def make_signed_id(mount, path, expires, download):
+	if isinstance(path, str):
+		path = path.encode('utf-8', errors='surrogateescape')
+	mount = mount.encode('utf-8')
+
+	# Encrypted, so that links don't give away the names of the mount and directories they point into
+	payload = signed_header.pack(expires, int(download), len(mount)) + mount + path
+	signature = get_signature(payload)
+	return signed_prefix + base64.urlsafe_b64encode(signature + apply_keystream(signature, payload)).rstrip(b'=').decode('ascii')
+
+def is_signed_id(id):
+	return id.startswith(signed_prefix)
+
+def load_revoked():
+	global revoked, revoked_loaded
+
+	with revoked_lock:
+		now = time.monotonic()
+		if revoked_loaded is None or now - revoked_loaded >= configuration.rid_revoked_refresh:
+			db = database.get_database()
+			revoked = frozenset(x for x, in db.execute('SELECT id FROM revoked_ids WHERE expires > ?', (int(time.time()),)))
+			revoked_loaded = now
+
+		return revoked
+
+def revoke_ids_unlocked(db, items):
+	global revoked
+
+	db.executemany('INSERT OR REPLACE INTO revoked_ids (id, expires) VALUES (?, ?)', items)
+	with revoked_lock:
+		revoked = revoked.union(x for x, _ in items)
+
+def parse_signed_id(id):
+	if not configuration.rid_signing_key or not is_signed_id(id):
+		return None
+
+	try:
+		data = base64.urlsafe_b64decode(id[len(signed_prefix):] + '=' * (-(len(id) - len(signed_prefix)) % 4))
+	except ValueError:
+		return None
+
+	signature = data[:signed_mac_length]
+	payload = apply_keystream(signature, data[signed_mac_length:])
+	if len(payload) < signed_header.size or not hmac.compare_digest(signature, get_signature(payload)):
+		return None
+
+	expires, download, mount_length = signed_header.unpack_from(payload)
+	mount = payload[signed_header.size:signed_header.size + mount_length]
+	path = payload[signed_header.size + mount_length:]
+	if len(mount) != mount_length:
+		return None
+
+	# Checked last, so that garbage never causes a database access
+	if id in load_revoked():
+		return None
+
+	return (expires, bool(download), mount.decode('utf-8', errors='replace'), path.decode('utf-8', errors='surrogateescape'))
+
 def validate_id(id):
+	if is_signed_id(id):
+		return len(id) > len(signed_prefix) and all(x.isascii() and (x.isalnum() or x in '-_') for x in id[len(signed_prefix):])
 	return len(id) == length and all(x in symbol_set for x in id)
 
 if __name__ == '__main__':
@@ -98,8 +266,8 @@ if __name__ == '__main__':
 	else:
 		count = 1
 
-	with contextlib.closing(database.open_database()) as db:
-		state_range = get_state_range(db, count)
+	# Loaded here, as it depends on this module
+	import linkstore
 
-	for state in state_range:
-		print(make_id(state))
+	for id in make_ids(linkstore.store.reserve_states(count)):
+		print(id)
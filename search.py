@@ -0,0 +1,151 @@
+#!/usr/bin/env python3.9
+import os
+import sys
+import contextlib
+import collections
+import common
+import configuration
+import database
+
+assert(isinstance(configuration.search_limit, int))
+
+Result = collections.namedtuple('Result', ['mount', 'directory', 'name', 'is_directory', 'mtime', 'used', 'size'])
+
+def is_encodable(name):
+	# Names that are not valid UTF-8 can't be stored as text, and are left out of the index
+	try:
+		name.encode('utf-8')
+		return True
+	except UnicodeEncodeError:
+		return False
+
+def to_column(path):
+	# Directories that are not valid UTF-8 are still crawled, their paths stored as blobs of the raw bytes, which only sort among themselves
+	return path if is_encodable(path) else os.fsencode(path)
+
+def from_column(path):
+	return os.fsdecode(path) if isinstance(path, bytes) else path
+
+def join_path(directory, name):
+	return '{0}/{1}'.format(directory, name) if directory else name
+
+def scan(mount, directory, fs_path, with_rows):
+	rows = []
+	subdirectories = []
+	directory_column = to_column(directory)
+
+	with os.scandir(fs_path) as entries:
+		for entry in entries:
+			try:
+				# Symbolic links are not followed, to avoid loops
+				if entry.is_dir(follow_symlinks=False):
+					subdirectories.append(entry.name)
+			except:
+				pass
+
+			if not with_rows or not is_encodable(entry.name):
+				continue
+
+			is_directory = False
+			try:
+				is_directory = entry.is_dir()
+			except:
+				pass
+
+			buf = None
+			try:
+				buf = entry.stat()
+			except:
+				pass
+
+			if is_directory:
+				rows.append((mount, directory_column, entry.name, 1, int(buf.st_mtime) if buf else None, None, None))
+			else:
+				rows.append((mount, directory_column, entry.name, 0, int(buf.st_mtime) if buf else None, buf.st_blocks * 512 if buf else None, buf.st_size if buf else None))
+
+	return (rows, subdirectories)
+
+def crawl_mount(db, mount, root, verbose=False):
+	known = {from_column(path): mtime for path, mtime in db.execute('SELECT path, mtime FROM search_directories WHERE mount = ?', (mount,))}
+	seen = set()
+	updated = 0
+
+	pending = ['']
+	while pending:
+		directory = pending.pop()
+		fs_path = os.path.join(root, directory) if directory else root
+		seen.add(directory)
+
+		try:
+			mtime = os.stat(fs_path).st_mtime_ns
+			changed = known.get(directory) != mtime
+			rows, subdirectories = scan(mount, directory, fs_path, changed)
+		except OSError:
+			continue
+
+		pending.extend(join_path(directory, x) for x in subdirectories)
+		if not changed:
+			continue
+
+		with db:
+			db.execute('DELETE FROM search_files WHERE mount = ? AND directory = ?', (mount, to_column(directory)))
+			db.executemany('INSERT INTO search_files (mount, directory, name, is_directory, mtime, used, size) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+			db.execute('INSERT OR REPLACE INTO search_directories (mount, path, mtime) VALUES (?, ?, ?)', (mount, to_column(directory), mtime))
+
+		updated += 1
+
+	removed = 0
+	for directory in known.keys() - seen:
+		with db:
+			db.execute('DELETE FROM search_files WHERE mount = ? AND directory = ?', (mount, to_column(directory)))
+			db.execute('DELETE FROM search_directories WHERE mount = ? AND path = ?', (mount, to_column(directory)))
+		removed += 1
+
+	if verbose:
+		print('{0}: {1} directories, {2} updated, {3} removed'.format(mount, len(seen), updated, removed))
+
+def crawl(verbose=False):
+	with contextlib.closing(database.open_database()) as db:
+		for mount, root in configuration.exported_directories.items():
+			crawl_mount(db, mount, root, verbose)
+
+		with db:
+			db.execute('DELETE FROM search_files WHERE mount NOT IN ({0})'.format(', '.join('?' * len(configuration.exported_directories))), tuple(configuration.exported_directories.keys()))
+			db.execute('DELETE FROM search_directories WHERE mount NOT IN ({0})'.format(', '.join('?' * len(configuration.exported_directories))), tuple(configuration.exported_directories.keys()))
+
+def make_query(terms):
+	# Every word is quoted so FTS5 operators typed by the user are matched literally, and prefix-matched
+	words = terms.split()
+	if not words:
+		return None
+
+	return ' '.join('"{0}"*'.format(x.replace('"', '""')) for x in words)
+
+def find(db, terms, mount=None, directory=''):
+	query = make_query(terms)
+	if not query:
+		return []
+
+	sql = ['SELECT f.mount, f.directory, f.name, f.is_directory, f.mtime, f.used, f.size FROM search_index JOIN search_files AS f ON f.rowid = search_index.rowid WHERE search_index MATCH ?']
+	parameters = [query]
+
+	if mount is not None:
+		sql.append('AND f.mount = ?')
+		parameters.append(mount)
+		if directory:
+			# Children of directory/ sort between "directory/" and "directory0", as '0' follows '/'
+			sql.append('AND (f.directory = ? OR (f.directory >= ? AND f.directory < ?))')
+			parameters.extend([to_column(directory), to_column(directory + '/'), to_column(directory + '0')])
+
+	sql.append('ORDER BY rank LIMIT ?')
+	parameters.append(configuration.search_limit)
+
+	return [Result(mount, from_column(directory), *rest) for mount, directory, *rest in db.execute(' '.join(sql), parameters)]
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		with contextlib.closing(database.open_database()) as db:
+			for result in find(db, ' '.join(sys.argv[1:])):
+				print('{0}/{1}'.format(result.mount, join_path(result.directory, result.name)))
+	else:
+		crawl(True)
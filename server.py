@@ -1,9 +1,11 @@
 #!/usr/bin/env python3.9
 import os
 import io
-import gzip
+import zlib
 import collections
 import flup.server.fcgi
+import flup.server.fcgi_fork
+import asyncserver
 import common
 import configuration
 import page
@@ -13,6 +15,18 @@ from gallery import handler as gallery_handler
 from download import handler as download_handler
 from thumbnail import handler as thumbnail_handler
 
+assert(isinstance(configuration.gzip_level, int) and 1 <= configuration.gzip_level <= 9)
+assert(isinstance(configuration.gzip_minimum_size, int))
+assert(configuration.server_mode in ('threaded', 'asyncio', 'prefork'))
+assert(isinstance(configuration.server_max_threads, int) and configuration.server_max_threads > 0)
+assert(isinstance(configuration.server_max_queued, int))
+assert(isinstance(configuration.server_min_spare, int))
+assert(isinstance(configuration.server_max_spare, int))
+assert(isinstance(configuration.server_max_children, int))
+assert(isinstance(configuration.server_max_requests, int))
+# Links handed out by one child could not be resolved by any other
+assert(configuration.server_mode != 'prefork' or configuration.link_store != 'memory')
+
 status_map = {
 	200 : 'OK',
 	303 : 'See Other',
@@ -22,21 +36,173 @@ status_map = {
 	500 : 'Internal Server Error'
 }
 
+# Amount of output gathered before being sent, once a response has begun, so that small writes don't each become a record
+chunk_size = 65536
+
+def make_status(code):
+	return '{0} {1}'.format(code, status_map[code])
+
+def accepts_encoding(environ, encoding):
+	# An explicit mention takes precedence over *, and a quality of 0 refuses
+	accepted = None
+	for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+		name, *parameters = [x.strip() for x in item.split(';')]
+		name = name.lower()
+		if name != encoding and (name != '*' or accepted is not None):
+			continue
+
+		quality = 1.0
+		for parameter in parameters:
+			key, _, value = parameter.partition('=')
+			if key.strip().lower() == 'q':
+				try:
+					quality = float(value)
+				except ValueError:
+					quality = 0.0
+
+		accepted = quality > 0.0
+		if name == encoding:
+			break
+
+	return bool(accepted)
+
+class ResponseWriter(io.RawIOBase):
+	# Output is kept until the response begins, and sent as it is written from then on
+	def __init__(self, start_response):
+		super().__init__()
+		self.start_response = start_response
+		self.begun = None
+		self.send = None
+		self.chunks = []
+		self.size = 0
+		# Added by wrappers, and sent along with the headers of the handler
+		self.headers = []
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		# Compressors mostly hand out nothing at all
+		if not data:
+			return 0
+
+		self.chunks.append(bytes(data))
+		self.size += len(data)
+		if self.begun and self.size >= chunk_size:
+			self.flush()
+		return len(data)
+
+	def start(self):
+		# Deferred until something gets sent, so that wrappers can still add headers
+		if not self.send:
+			code, headers = self.begun
+			self.send = self.start_response(make_status(code), headers + self.headers)
+
+	def flush(self):
+		if self.begun and self.chunks:
+			self.start()
+			self.send(b''.join(self.chunks))
+			self.chunks = []
+			self.size = 0
+
+	def close(self):
+		if not self.closed and self.begun:
+			self.flush()
+			self.start()
+		super().close()
+
+	def __exit__(self, *exc_info):
+		# A failed response is not sent as if it were complete, and can still become an error page if nothing went out yet
+		if exc_info[0]:
+			self.begun = None
+		return super().__exit__(*exc_info)
+
+	def begin(self, code, headers):
+		self.begun = (code, headers)
+
+	def getvalue(self):
+		return b''.join(self.chunks)
+
+class GzipWriter(io.RawIOBase):
+	# Compression only starts once there is enough output for it to be worth it, or once output has to be sent
+	def __init__(self, writer):
+		super().__init__()
+		self.writer = writer
+		self.compressor = None
+		self.chunks = []
+		self.size = 0
+		self.finished = False
+
+	def writable(self):
+		return True
+
+	def start(self):
+		self.writer.headers.append(('Content-Encoding', 'gzip'))
+		self.compressor = zlib.compressobj(configuration.gzip_level, zlib.DEFLATED, 31)
+		self.writer.write(self.compressor.compress(b''.join(self.chunks)))
+		self.chunks = []
+
+	def write(self, data):
+		if self.compressor:
+			self.writer.write(self.compressor.compress(data))
+		else:
+			self.chunks.append(bytes(data))
+			self.size += len(data)
+			if self.size >= configuration.gzip_minimum_size:
+				self.start()
+		return len(data)
+
+	def flush(self):
+		# Output is only sent once the response has begun anyway
+		if self.finished or not self.writer.begun:
+			return
+
+		if not self.compressor:
+			self.start()
+		self.writer.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+		self.writer.flush()
+
+	def close(self):
+		if not self.closed and not self.finished:
+			if self.compressor:
+				self.writer.write(self.compressor.flush())
+			else:
+				self.writer.write(b''.join(self.chunks))
+			self.finished = True
+		super().close()
+
+	def __exit__(self, *exc_info):
+		if exc_info[0]:
+			self.finished = True
+		return super().__exit__(*exc_info)
+
+class TextWriter:
+	__slots__ = ('writer',)
+
+	def __init__(self, writer):
+		self.writer = writer
+
+	def write(self, text):
+		self.writer.write(text.encode('utf-8', errors='replace'))
+		return len(text)
+
+	def flush(self):
+		self.writer.flush()
+
 def null_wrapper(handler, environ, writer, parameter):
 	return handler(environ, writer, parameter)
 
 def text_wrapper(handler, environ, writer, parameter):
-	wrapper = io.TextIOWrapper(writer, encoding='utf-8', errors='replace', write_through=True)
-	try:
-		return handler(environ, wrapper, parameter)
-	finally:
-		wrapper.detach()
+	return handler(environ, TextWriter(writer), parameter)
 
 def gzip_wrapper(handler, environ, writer, parameter):
-	with gzip.GzipFile(fileobj=writer, mode='wb') as gzwriter:
-		result = handler(environ, gzwriter, parameter)
-	result[1].append(('Content-Encoding', 'gzip'))
-	return result
+	# Whether compressed or not, the response depends on it
+	writer.headers.append(('Vary', 'Accept-Encoding'))
+	if not accepts_encoding(environ, 'gzip'):
+		return handler(environ, writer, parameter)
+
+	with GzipWriter(writer) as gzwriter:
+		return handler(environ, gzwriter, parameter)
 
 def default_handler(environ, writer, parameter):
 	return page.render_error_page(environ, writer, 404, 'No such module.')
@@ -53,7 +219,8 @@ module_map = {
 default_module = Module('', default_handler, True, False)
 
 def dispatcher(environ, start_response):
-	with io.BytesIO() as writer:
+	with ResponseWriter(start_response) as writer:
+		environ['archive.response'] = writer
 		module = module_map.get(environ.get('archive.module'), default_module)
 
 		parameter = environ['DOCUMENT_URI']
@@ -67,9 +234,21 @@ def dispatcher(environ, start_response):
 			handler = lambda e,w,p,h=handler: gzip_wrapper(h, e, w, p)
 
 		result = handler(environ, writer, parameter)
-		start_response('{0} {1}'.format(result[0], status_map[result[0]]), result[1])
+
+		# Whatever is left gets sent once closed
+		if writer.begun:
+			return []
+
+		start_response(make_status(result[0]), result[1] + writer.headers)
 		return [writer.getvalue()]
 
 if __name__ == '__main__':
 	os.umask(0o002)
-	flup.server.fcgi.WSGIServer(dispatcher, bindAddress=common.socket_path, umask=0, debug=configuration.debug).run()
+	if configuration.server_mode == 'asyncio':
+		asyncserver.Server(dispatcher).run(common.socket_path, 0)
+	elif configuration.server_mode == 'prefork':
+		flup.server.fcgi_fork.WSGIServer(dispatcher, bindAddress=common.socket_path, umask=0, debug=configuration.debug, minSpare=configuration.server_min_spare, maxSpare=configuration.server_max_spare, maxChildren=configuration.server_max_children, maxRequests=configuration.server_max_requests).run()
+	else:
+		fcgi_server = flup.server.fcgi.WSGIServer(dispatcher, bindAddress=common.socket_path, umask=0, debug=configuration.debug, maxThreads=configuration.server_max_threads, maxQueued=configuration.server_max_queued)
+		fcgi_server.environ['archive.server_counters'] = fcgi_server.getCounters
+		fcgi_server.run()
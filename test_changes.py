@@ -0,0 +1,41 @@
+#!/usr/bin/env python3.9
+import os
+import time
+import tempfile
+import unittest
+import changes
+
+def wait_for_sequence(value, timeout=5.0):
+	# Events are read by another thread
+	deadline = time.monotonic() + timeout
+	while changes.sequence <= value and time.monotonic() < deadline:
+		time.sleep(0.01)
+
+class ChangesTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = self.directory.name
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_directory_attributes(self):
+		token = changes.watch(self.path)
+		self.assertIsNotNone(token)
+
+		# Raises IN_ATTRIB on the directory itself, which has no name
+		os.chmod(self.path, 0o700)
+		with open(os.path.join(self.path, 'file'), 'w'):
+			pass
+		wait_for_sequence(changes.parse_token(token))
+
+		token, changed = changes.get_changes(self.path, token)
+		self.assertNotIn('', changed)
+		self.assertIn('file', changed)
+
+		os.chmod(self.path, 0o755)
+		time.sleep(0.1)
+		self.assertEqual(changes.get_changes(self.path, token), (token, {}))
+
+if __name__ == '__main__':
+	unittest.main()
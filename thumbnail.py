@@ -2,20 +2,19 @@
 import os
 import sys
 import time
-import contextlib
 import fcntl
 import json
 import base64
+import random
 import hashlib
-import threading
 import shutil
 import tempfile
 import subprocess
 import traceback
 import common
 import configuration
-import database
 import randomid
+import idcache
 import page
 
 nice_binary = '/usr/bin/nice'
@@ -32,7 +31,35 @@ assert(isinstance(configuration.thumbnail_animated_framerate, int) or isinstance
 thumbnail_size = 128
 
 thumbnail_filter = 'format=rgb24,scale=iw*min({0}/iw\\,{0}/ih):ih*min({0}/iw\\,{0}/ih)'
-thumbnail_semaphore = threading.Semaphore(configuration.thumbnail_concurrent)
+
+# Generations take seconds, so waiting for a free slot can afford to poll
+thumbnail_slot_interval = 0.1
+
+def acquire_slot():
+	# Generations are counted across every server process, each holding a lock on one of as many files
+	fds = []
+	try:
+		for i in range(configuration.thumbnail_concurrent):
+			fds.append(os.open(os.path.join(configuration.socket_directory, 'thumbnail.{0}.lock'.format(i)), os.O_RDONLY|os.O_CREAT, 0o0666))
+		random.shuffle(fds)
+
+		# Blocking on any one of them could keep waiting while another gets free
+		while True:
+			for fd in fds:
+				try:
+					fcntl.flock(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+				except BlockingIOError:
+					continue
+				fds.remove(fd)
+				return fd
+			time.sleep(thumbnail_slot_interval)
+	finally:
+		for fd in fds:
+			os.close(fd)
+
+def release_slot(fd):
+	fcntl.flock(fd, fcntl.LOCK_UN)
+	os.close(fd)
 
 def id_scale_from_parameter_unvalidated(parameter):
 	split = parameter.split('@', 1)
@@ -136,7 +163,7 @@ def create_thumbnail(in_path, out_path, scale, is_video, animated):
 		convert_media_to_static(in_path, out_path, scale, duration)
 
 def get_or_create_thumbnail(fs_path, scale, animated):
-	is_video = os.path.splitext(fs_path)[1].lower() in configuration.video_extensions
+	is_video = common.media_kinds.get(os.path.splitext(fs_path)[1].lower()) == 'video'
 	filename = make_thumbnail_filename(fs_path, scale, animated)
 
 	if animated and not is_video:
@@ -153,11 +180,11 @@ def get_or_create_thumbnail(fs_path, scale, animated):
 		fd_locked = True
 
 		if not existed and not os.path.getsize(out_path):
-			thumbnail_semaphore.acquire()
+			slot = acquire_slot()
 			try:
 				create_thumbnail(fs_path, out_path, scale, is_video, animated)
 			finally:
-				thumbnail_semaphore.release()
+				release_slot(slot)
 
 		if os.path.getsize(out_path):
 			return filename
@@ -184,8 +211,16 @@ def handler(environ, writer, parameter):
 	else:
 		return make_thumbnail_error(1, 'invalid-scale')
 
-	with contextlib.closing(database.open_database()) as db:
-		result = db.execute('SELECT mount, path FROM ids WHERE id = ? AND expires > ?', (id, int(time.time()))).fetchone()
+	if randomid.is_signed_id(id):
+		result = randomid.parse_signed_id(id)
+		result = result[2:] if result and result[0] > int(time.time()) else None
+	else:
+		parsed = randomid.parse_id(id)
+		if not parsed:
+			return make_thumbnail_error(scale, 'invalid-id')
+
+		result = idcache.lookup(*parsed)
+		result = result[2:] if result else None
 
 	if not result:
 		return make_thumbnail_error(scale, 'expired-id')
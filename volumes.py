@@ -0,0 +1,90 @@
+#!/usr/bin/env python3.9
+import os
+import time
+import threading
+import collections
+import common
+import configuration
+
+assert(isinstance(configuration.volume_refresh_interval, int) or isinstance(configuration.volume_refresh_interval, float))
+assert(isinstance(configuration.volume_refresh_timeout, int) or isinstance(configuration.volume_refresh_timeout, float))
+
+Usage = collections.namedtuple('Usage', ['used', 'size', 'stale'])
+
+lock = threading.Lock()
+started = False
+# Mount name to (used, size, time of the last successful probe)
+results = {}
+# Mounts whose probe has not returned yet, possibly hung on an unresponsive filesystem
+probing = set()
+
+def reset_after_fork():
+	# Threads don't survive fork, so a child starts its own
+	global lock, started
+
+	lock = threading.Lock()
+	started = False
+	probing.clear()
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def probe(name, fs_path):
+	try:
+		statbuf = os.statvfs(fs_path)
+		result = ((statbuf.f_blocks - statbuf.f_bfree) * statbuf.f_frsize, statbuf.f_blocks * statbuf.f_frsize, time.monotonic())
+	except:
+		result = None
+
+	with lock:
+		probing.discard(name)
+		if result:
+			results[name] = result
+		else:
+			results.pop(name, None)
+
+def refresh():
+	threads = []
+	for name, fs_path in configuration.exported_directories.items():
+		with lock:
+			if name in probing:
+				continue
+			probing.add(name)
+
+		thread = threading.Thread(target=probe, args=(name, fs_path), name='statvfs-{0}'.format(name), daemon=True)
+		thread.start()
+		threads.append(thread)
+
+	deadline = time.monotonic() + configuration.volume_refresh_timeout
+	for thread in threads:
+		thread.join(max(0.0, deadline - time.monotonic()))
+
+def run():
+	while True:
+		refresh()
+		time.sleep(configuration.volume_refresh_interval)
+
+def start():
+	global started
+
+	with lock:
+		if started:
+			return
+		started = True
+
+	threading.Thread(target=run, name='volumes', daemon=True).start()
+
+def get_usage(name):
+	# Sizes are unknown until the first probe returns, pages don't wait for it
+	start()
+
+	with lock:
+		result = results.get(name)
+		pending = name in probing
+
+	if not result:
+		# Still being probed, rather than unavailable
+		return Usage(None, None, pending)
+
+	used, size, updated = result
+	stale = time.monotonic() - updated > configuration.volume_refresh_interval + configuration.volume_refresh_timeout
+	return Usage(used, size, stale)